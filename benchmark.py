@@ -0,0 +1,543 @@
+import argparse
+import contextlib
+import hashlib
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import re
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+
+
+# -----------------------------------------------
+
+
+
+# локальная подмена каталога, CKAN API, файловых хостов и сервиса SHACL:
+# страницы, data.json, пакеты CKAN и файлы собираются из шаблонов,
+# задержка и ошибки настраиваются
+
+pageTemplate = """<html><body>
+<h1 itemprop="name">  {title}  </h1>
+<section id="dataset-resources"><ul>
+<li><span class="format-label">CSV</span><a href="{base}/files/{name}.csv" data-format="csv"><i class="fa fa-download"></i>Download</a></li>
+<li><span class="format-label">JSON</span><a href="{base}/files/{name}.json" data-format="json"><i class="fa fa-download"></i>Download</a></li>
+<li><span class="format-label">XLSX</span><a href="{base}/files/{name}.xlsx" data-format="xlsx"><i class="fa fa-download"></i>Download</a></li>
+<li><span class="format-label">Landing Page</span></li>
+</ul></section>
+<section id="dataset-metadata-source"><span class="format-label">Data.json</span><a href="/harvest/object/{name}">Download Metadata</a></section>
+<section class="additional-info"><table>
+<tr><th>License</th><td> http://www.usa.gov/publicdomain/label/1.0/ </td></tr>
+<tr><th>Public Access Level</th><td>public</td></tr>
+<tr><th>Metadata Updated Date</th><td>2024-01-01</td></tr>
+</table></section>
+<p><strong>License:</strong> Creative Commons Attribution </p>
+<a title="contact" href="mailto:data@example.org">contact</a>
+<a title="publsher" href="/organization/example">Example Agency</a>
+</body></html>
+"""
+
+turtleTemplate = """@prefix dcat: <http://www.w3.org/ns/dcat#> .
+@prefix dct: <http://purl.org/dc/terms/> .
+<{base}/dataset/{name}> a dcat:Dataset ; dct:title "{title}" .
+"""
+
+class StandIn:
+    def __init__(self, fixtures, latency = 0.0, errorRate = 0.0, seed = 0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.errorRate = errorRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "errors": 0, "bytes": 0}
+        self.server = None
+        self.base = None
+
+    def count(self, key, value = 1):
+        with self.lock:
+            self.stats[key] += value
+
+    def isFailing(self):
+        with self.lock:
+            return self.random.random() < self.errorRate
+
+    def makePackage(self, name):
+        # пакет CKAN с теми же ресурсами, что и страница датасета
+        resources = []
+        for format, extension, mimetype in [
+            ("CSV",    "csv",  "text/csv"),
+            ("JSON",   "json", "application/json"),
+            ("XLSX",   "xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+            ("Turtle", "ttl",  "text/turtle"),
+        ]:
+            resources.append({"format": format, "mimetype": mimetype, "url": self.base + "/files/" + name + "." + extension})
+        return {
+            "name":              name,
+            "title":             name,
+            "license_title":     "Creative Commons Attribution",
+            "license_url":       "http://www.usa.gov/publicdomain/label/1.0/",
+            "maintainer_email":  "data@example.org",
+            "metadata_modified": "2024-01-01T00:00:00",
+            "organization":      {"title": "Example Agency"},
+            "extras":            [{"key": "accessLevel", "value": "public"}],
+            "resources":         resources,
+        }
+
+    def routeCkan(self, action, query):
+        if action == "package_show":
+            name = query.get("id", [""])[0]
+            return json.dumps({"success": True, "result": self.makePackage(name)}).encode("utf-8"), "application/json"
+        if action == "package_search":
+            # поддерживается только fq=name:("a" OR "b"), как у fetchPackageBatch
+            names = re.findall(r'"([^"]+)"', query.get("fq", [""])[0])
+            rows = int(query.get("rows", ["10"])[0])
+            packages = [self.makePackage(name) for name in names[:rows]]
+            result = {"count": len(packages), "results": packages}
+            return json.dumps({"success": True, "result": result}).encode("utf-8"), "application/json"
+        return None, None
+
+    def route(self, path, query = None):
+        name = path.rsplit("/", 1)[-1]
+        if path.startswith("/api/3/action/"):
+            return self.routeCkan(name, query or {})
+        if path.startswith("/dataset/"):
+            return pageTemplate.format(base = self.base, name = name, title = name).encode("utf-8"), "text/html"
+        if path.startswith("/harvest/object/"):
+            document = {"distribution": [
+                {"mediaType": "text/turtle", "downloadURL": self.base + "/files/" + name + ".ttl"},
+                {"mediaType": "text/csv",    "downloadURL": self.base + "/files/" + name + ".csv"},
+            ]}
+            return json.dumps(document).encode("utf-8"), "application/json"
+        if path.startswith("/files/") and name.endswith(".ttl"):
+            stem = name[:-len(".ttl")]
+            return turtleTemplate.format(base = self.base, name = stem, title = stem).encode("utf-8"), "text/turtle"
+        if path.startswith("/files/"):
+            extension = name.rsplit(".", 1)[-1]
+            filePath = self.fixtures.get(extension)
+            if filePath is not None:
+                contentType = {
+                    "csv":  "text/csv",
+                    "json": "application/json",
+                    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                }[extension]
+                return filePath, contentType
+        return None, None
+
+    def start(self):
+        standIn = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def getRange(self, size):
+                # только один диапазон "bytes=start-end" или "bytes=start-", как у пробы формата
+                match = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+                if match is None or int(match.group(1)) >= size:
+                    return None
+                start = int(match.group(1))
+                end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+                return start, end
+
+            def sendRange(self, contentRange, size):
+                if contentRange is None:
+                    self.send_response(200)
+                    self.send_header("Content-Length", str(size))
+                else:
+                    self.send_response(206)
+                    self.send_header("Content-Range", "bytes %d-%d/%d" % (contentRange[0], contentRange[1], size))
+                    self.send_header("Content-Length", str(contentRange[1] - contentRange[0] + 1))
+
+            def reply(self, code, body, contentType, head = False):
+                contentRange = self.getRange(len(body)) if code == 200 else None
+                if contentRange is None:
+                    self.send_response(code)
+                    self.send_header("Content-Length", str(len(body)))
+                else:
+                    self.sendRange(contentRange, len(body))
+                    body = body[contentRange[0]:contentRange[1] + 1]
+                self.send_header("Content-Type", contentType)
+                self.send_header("ETag", '"' + hashlib.md5(body).hexdigest() + '"')
+                self.end_headers()
+                if not head:
+                    self.wfile.write(body)
+                    standIn.count("bytes", len(body))
+
+            def replyFile(self, filePath, contentType, head = False):
+                size = os.path.getsize(filePath)
+                contentRange = self.getRange(size)
+                self.sendRange(contentRange, size)
+                self.send_header("Content-Type", contentType)
+                self.end_headers()
+                if head:
+                    return
+                start, end = contentRange if contentRange is not None else (0, size - 1)
+                left = end - start + 1
+                with open(filePath, "rb") as file:
+                    file.seek(start)
+                    while left > 0:
+                        chunk = file.read(min(2**20, left))
+                        if not chunk:
+                            break
+                        # клиент может закрыть соединение, не дочитав, - считаем отправленное
+                        try:
+                            self.wfile.write(chunk)
+                        except ConnectionError:
+                            break
+                        standIn.count("bytes", len(chunk))
+                        left -= len(chunk)
+
+            def do_GET(self, head = False):
+                standIn.count("requests")
+                if standIn.latency:
+                    time.sleep(standIn.latency)
+                if standIn.isFailing():
+                    standIn.count("errors")
+                    return self.reply(503, b"unavailable", "text/plain", head)
+
+                url = urlparse(self.path)
+                body, contentType = standIn.route(url.path, parse_qs(url.query))
+                if body is None:
+                    return self.reply(404, b"not found", "text/plain", head)
+                if isinstance(body, str):
+                    return self.replyFile(body, contentType, head)
+                return self.reply(200, body, contentType, head)
+
+            def do_HEAD(self):
+                self.do_GET(head = True)
+
+            def do_POST(self):
+                # ответ сервиса SHACL: RDF проходит, остальное - 400
+                standIn.count("requests")
+                length = int(self.headers.get("Content-Length") or 0)
+                self.rfile.read(length)
+                if standIn.latency:
+                    time.sleep(standIn.latency)
+                if "turtle" in (self.headers.get("Content-Type") or ""):
+                    return self.reply(200, b'{"conforms": true}', "application/json")
+                return self.reply(400, b'{"error": "not RDF"}', "application/json")
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base = "http://127.0.0.1:" + str(self.server.server_address[1])
+        threading.Thread(target = self.server.serve_forever, daemon = True).start()
+        return self.base
+
+    def stop(self):
+        self.server.shutdown()
+
+
+
+# -----------------------------------------------
+
+
+
+def generateCsv(fileName, rows, seed = 0, chunkRows = 100000):
+    # числа, дроби с пропусками, годы, категории и уникальные строки;
+    # одинаковый seed - одинаковый файл
+    rng = np.random.default_rng(seed)
+    categories = np.array(["alpha", "beta", "gamma", "delta", "epsilon"])
+
+    with open(fileName, "w", encoding="utf-8") as file:
+        file.write("name,id,mass,year,class\n")
+        for start in range(0, rows, chunkRows):
+            n = min(chunkRows, rows - start)
+            ids = np.arange(start, start + n)
+            mass = rng.random(n) * 100
+            missing = rng.random(n) < 0.3
+            year = rng.integers(1900, 2021, n)
+            cls = categories[rng.integers(0, len(categories), n)]
+            lines = []
+            for i in range(n):
+                lines.append("row-" + str(ids[i]) + "," + str(ids[i]) + "," +
+                             ("" if missing[i] else repr(float(mass[i]))) + "," +
+                             str(year[i]) + "," + cls[i])
+            file.write("\n".join(lines) + "\n")
+    return fileName
+
+def generateJson(fileName, rows, seed = 0):
+    rng = np.random.default_rng(seed)
+    with open(fileName, "w", encoding="utf-8") as file:
+        file.write("[")
+        for i in range(rows):
+            if i:
+                file.write(",")
+            file.write(json.dumps({"id": i, "value": float(rng.random()), "group": "g" + str(i % 7)}))
+        file.write("]")
+    return fileName
+
+def generateXlsx(fileName, rows, seed = 0):
+    import openpyxl
+    rng = np.random.default_rng(seed)
+    wb = openpyxl.Workbook(write_only = True)
+    ws = wb.create_sheet("data")
+    ws.append(["id", "value", "group"])
+    for i in range(rows):
+        ws.append([i, float(rng.random()), "g" + str(i % 7)])
+    wb.save(fileName)
+    return fileName
+
+def makeFixtures(directory, rows, seed):
+    os.makedirs(directory, exist_ok = True)
+    return {
+        "csv":  generateCsv(os.path.join(directory, "data.csv"), rows, seed),
+        "json": generateJson(os.path.join(directory, "data.json"), min(rows, 100000), seed),
+        "xlsx": generateXlsx(os.path.join(directory, "data.xlsx"), min(rows, 20000), seed),
+    }
+
+
+
+# -----------------------------------------------
+
+
+
+def getPercentiles(values):
+    if not values:
+        return None
+    values = np.array(values)
+    return {
+        "p50":  float(np.percentile(values, 50)),
+        "p90":  float(np.percentile(values, 90)),
+        "p99":  float(np.percentile(values, 99)),
+        "max":  float(values.max()),
+        "mean": float(values.mean()),
+    }
+
+def getStagePercentiles(timingsList):
+    stages = {}
+    for timings in timingsList:
+        for stage, value in timings.items():
+            stages.setdefault(stage, []).append(value)
+    return {stage: getPercentiles(values) for stage, values in stages.items()}
+
+def getPeakRss():
+    # ru_maxrss в килобайтах; процессы пула считаются отдельно
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+    return {"self": own, "children": children}
+
+def prepareMain(main, base, args):
+    main.catalogUrl = base
+    main.ckanApiUrl = base + "/api/3/action"
+    main.dcatapValidator = "remote"
+    main.dcatapServiceUrl = base + "/shacl"
+    main.useStateStore = False
+    main.maxWorkers = args.workers
+    main.cpuWorkers = args.cpu_workers
+    main.profilingMode = args.profiling_mode
+
+    with open("MediaTypeVocabulary.txt", "w", encoding="utf-8") as file:
+        file.write("text/csv\ntext/turtle\napplication/json\n")
+    with open("LicencesVocabulary.txt", "w", encoding="utf-8") as file:
+        file.write("http://www.usa.gov/publicdomain/label/1.0/\nCreative Commons Attribution\n")
+
+def benchCheckOne(main, standIn, args):
+    # весь прогон checkAll: страница, data.json, DCAT-AP, файлы, отчёты
+    urls = [main.catalogUrl + "/dataset/bench-" + str(i) for i in range(args.datasets)]
+
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        main.checkAll(urls, True)
+    elapsed = time.perf_counter() - started
+
+    timings = []
+    with open(main.resultsFile, "r", encoding="utf-8") as file:
+        for line in file:
+            timings.append(json.loads(line)["timings"])
+
+    return {
+        "datasets":         len(urls),
+        "checked":          len(timings),
+        "seconds":          elapsed,
+        "datasets_per_sec": len(timings) / elapsed if elapsed else None,
+        "stages":           getStagePercentiles(timings),
+    }
+
+def benchCheckOneCkan(main, standIn, args):
+    # то же через CKAN API: пачки package_search вместо страниц
+    main.metadataSource = "ckan"
+    return benchCheckOne(main, standIn, args)
+
+def benchCheckFiles(main, standIn, args):
+    # скачивание и профилирование одного большого CSV
+    link = ("csv", main.catalogUrl + "/files/big.csv")
+    size = os.path.getsize(standIn.fixtures["csv"])
+
+    timings = []
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(args.repeat):
+            shutil.rmtree(main.cacheDir, ignore_errors = True)
+            stageTimings = {}
+            started = time.perf_counter()
+            main.checkFiles_d([link], "bench", stageTimings)
+            latencies.append(time.perf_counter() - started)
+            timings.append(stageTimings)
+    main.shutdownCpuPool()
+
+    return {
+        "rows":          args.rows,
+        "file_bytes":    size,
+        "repeat":        args.repeat,
+        "latency":       getPercentiles(latencies),
+        "mb_per_sec":    size / 2**20 / float(np.median(latencies)),
+        "stages":        getStagePercentiles(timings),
+    }
+
+def benchMakeExcel(main, standIn, args):
+    # запись отчёта по готовому профилю, без сети
+    with contextlib.redirect_stdout(io.StringIO()):
+        File_Info = main.profileCsv(standIn.fixtures["csv"])
+    Interoperability_Info = {label: True for label in main.reportLabels[:6]}
+    Interoperability_Info["InteroperabilityPoints"] = 100
+    Reusability_Info = {label: True for label in main.reportLabels[6:12]}
+    Reusability_Info["ReusabilityPoints"] = 75
+
+    os.makedirs("reports", exist_ok = True)
+    latencies = []
+    for i in range(args.repeat):
+        started = time.perf_counter()
+        main.makeExcel(os.path.join("reports", "bench-" + str(i)), "bench", Interoperability_Info, Reusability_Info, File_Info)
+        latencies.append(time.perf_counter() - started)
+
+    return {
+        "repeat":   args.repeat,
+        "columns":  File_Info["num_columns"],
+        "latency":  getPercentiles(latencies),
+    }
+
+benchmarks = {
+    "checkOne":     benchCheckOne,
+    "checkOneCkan": benchCheckOneCkan,
+    "checkFiles_d": benchCheckFiles,
+    "makeExcel":    benchMakeExcel,
+}
+
+def runOne(name, args):
+    # один замер - один процесс: пиковая память не смешивается между замерами
+    workDir = tempfile.mkdtemp(prefix = "bench-")
+    try:
+        fixtures = makeFixtures(os.path.join(workDir, "fixtures"), args.rows, args.seed)
+        os.chdir(workDir)
+
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import main
+
+        standIn = StandIn(fixtures, args.latency, args.error_rate, args.seed)
+        base = standIn.start()
+        prepareMain(main, base, args)
+
+        result = benchmarks[name](main, standIn, args)
+        result["http"] = dict(standIn.stats)
+        result["peak_rss"] = getPeakRss()
+        standIn.stop()
+        return result
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(workDir, ignore_errors = True)
+
+def getVersion():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output = True, text = True,
+            cwd = os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+def compareResults(old, new):
+    for name, result in new["benchmarks"].items():
+        before = old["benchmarks"].get(name)
+        if before is None:
+            continue
+        for key in ["datasets_per_sec", "mb_per_sec"]:
+            if key in result and before.get(key):
+                print(name, key, "%.3f -> %.3f (%+.1f%%)" % (
+                    before[key], result[key], (result[key] / before[key] - 1) * 100))
+        if "latency" in result and before.get("latency"):
+            print(name, "latency p50", "%.4f -> %.4f (%+.1f%%)" % (
+                before["latency"]["p50"], result["latency"]["p50"],
+                (result["latency"]["p50"] / before["latency"]["p50"] - 1) * 100))
+
+def parseArgs(argv = None):
+    parser = argparse.ArgumentParser(description = "Замеры checkAll на локальной подмене каталога")
+    parser.add_argument("benchmarks", nargs = "*", help = "какие замеры: " + ", ".join(benchmarks) + " (по умолчанию все)")
+    parser.add_argument("--datasets", type = int, default = 50, help = "датасетов в замере checkOne")
+    parser.add_argument("--rows", type = int, default = 200000, help = "строк в синтетическом CSV")
+    parser.add_argument("--repeat", type = int, default = 5, help = "повторов в замерах checkFiles_d и makeExcel")
+    parser.add_argument("--latency", type = float, default = 0.0, help = "задержка ответа подмены, с")
+    parser.add_argument("--error-rate", type = float, default = 0.0, help = "доля ответов 503")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--workers", type = int, default = 8, help = "maxWorkers")
+    parser.add_argument("--cpu-workers", type = int, default = None, help = "cpuWorkers")
+    parser.add_argument("--profiling-mode", default = "exact", choices = ["exact", "approximate", "sample"])
+    parser.add_argument("--output", default = None, help = "куда записать JSON с результатами")
+    parser.add_argument("--compare", default = None, help = "JSON прошлого замера для сравнения")
+    parser.add_argument("--run-one", default = None, help = argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    for name in args.benchmarks:
+        if name not in benchmarks:
+            parser.error("нет замера " + name)
+    if not args.benchmarks:
+        args.benchmarks = list(benchmarks)
+    return args
+
+def main(argv = None):
+    args = parseArgs(argv)
+
+    if args.run_one:
+        json.dump(runOne(args.run_one, args), sys.stdout)
+        return
+
+    passed = [a for a in (argv if argv is not None else sys.argv[1:]) if a not in benchmarks]
+    report = {
+        "version":    getVersion(),
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python":     platform.python_version(),
+        "cpus":       os.cpu_count(),
+        "settings":   {k: v for k, v in vars(args).items() if k not in ("benchmarks", "output", "compare", "run_one")},
+        "benchmarks": {},
+    }
+    for name in args.benchmarks:
+        print("замер " + name + "...", file = sys.stderr)
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--run-one", name] + passed,
+            capture_output = True, text = True
+        )
+        if completed.returncode != 0:
+            print(completed.stderr, file = sys.stderr)
+            report["benchmarks"][name] = {"error": completed.stderr.strip().splitlines()[-1:]}
+            continue
+        report["benchmarks"][name] = json.loads(completed.stdout)
+
+    text = json.dumps(report, indent = 2, ensure_ascii = False)
+    if args.output:
+        directory = os.path.dirname(args.output)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        with open(args.output, "w", encoding="utf-8") as file:
+            file.write(text)
+    print(text)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            compareResults(json.load(file), report)
+
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,27 @@ import json
 import os
 import sys
 import io
-import pandas as pd
-import openpyxl
+import threading
+import queue
+import time
+import random
+import hashlib
+import logging
+import sqlite3
+import math
+import argparse
+import importlib
+import csv
+import re
+import struct
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from itertools import zip_longest
-from bs4 import BeautifulSoup as bs
-from collections import OrderedDict 
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+import multiprocessing
+from urllib.parse import urlparse, urlencode, quote
 
 
 
@@ -15,10 +31,32 @@ from collections import OrderedDict
 
 
 
+class LazyModule:
+    # модуль импортируется при первом обращении: проверка только метаданных
+    # не платит за загрузку pandas и openpyxl
+    
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+    
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+np = LazyModule("numpy")
+pd = LazyModule("pandas")
+openpyxl = LazyModule("openpyxl")
+
+def bs(markup, features):
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(markup, features)
+
 def createId(link):
-    if "https://catalog.data.gov/dataset/" not in link:
+    prefix = catalogUrl + "/dataset/"
+    if prefix not in link:
         return "temp"
-    return link.replace("https://catalog.data.gov/dataset/", "")
+    return link.replace(prefix, "")
 
 def getReadableSize(size):
     power = 2**10  # 1024
@@ -30,21 +68,1441 @@ def getReadableSize(size):
     size = round(size, 2)
     return f"{size}{units[n]}"
 
-def findTitle(soup):
-    title = soup.find("h1", itemprop="name")
-    if title is None:
+
+
+# -----------------------------------------------
+
+
+
+# отладочный вывод: уровни logLevel, сообщения форматируются только если уровень включён
+log = logging.getLogger(__name__)
+
+class StdoutHandler(logging.StreamHandler):
+    # пишет в текущий sys.stdout, чтобы вывод потока попадал в его буфер ThreadOutput
+    
+    @property
+    def stream(self):
+        return sys.stdout
+    
+    @stream.setter
+    def stream(self, value):
+        pass
+
+def setupLogging():
+    if not log.handlers:
+        handler = StdoutHandler()
+        handler.setFormatter(logging.Formatter(" @ %(message)s"))
+        log.addHandler(handler)
+        log.propagate = False
+    log.setLevel(logLevel)
+
+# счётчики и время этапов за прогон: сводка в JSON и в текстовом формате Prometheus
+metrics = {"counters": {}, "failures": {}, "stages": {}}
+metricsLock = threading.Lock()
+checkFailures = threading.local()
+stageBuckets = [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+
+def countMetric(name, value = 1):
+    with metricsLock:
+        metrics["counters"][name] = metrics["counters"].get(name, 0) + value
+
+def countFailure(kind):
+    with metricsLock:
+        metrics["failures"][kind] = metrics["failures"].get(kind, 0) + 1
+    # сбои текущего датасета: результат с ними не переиспользуется
+    kinds = getattr(checkFailures, "kinds", None)
+    if kinds is not None:
+        kinds.append(kind)
+
+def observeStage(name, seconds):
+    with metricsLock:
+        stage = metrics["stages"].get(name)
+        if stage is None:
+            stage = {"count": 0, "sum": 0.0, "max": 0.0, "buckets": [0] * len(stageBuckets)}
+            metrics["stages"][name] = stage
+        stage["count"] += 1
+        stage["sum"] += seconds
+        stage["max"] = max(stage["max"], seconds)
+        for i, bound in enumerate(stageBuckets):
+            if seconds <= bound:
+                stage["buckets"][i] += 1
+                break
+
+def getMetrics():
+    with metricsLock:
+        snapshot = {
+            "counters": dict(metrics["counters"]),
+            "failures": dict(metrics["failures"]),
+            "stages":   {name: dict(stage, buckets = list(stage["buckets"])) for name, stage in metrics["stages"].items()},
+        }
+    for stage in snapshot["stages"].values():
+        stage["mean"] = stage["sum"] / stage["count"] if stage["count"] else 0.0
+    snapshot["hosts"] = getHostStats()
+    snapshot["caches"] = {
+        "http":      dict(httpCacheStats),
+        "downloads": dict(downloadCacheStats),
+        "dcatap":    dict(dcatapCacheStats),
+    }
+    return snapshot
+
+def escapeLabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def formatPrometheus(snapshot):
+    lines = []
+    
+    lines.append("# TYPE datacheck_stage_seconds histogram")
+    for name, stage in sorted(snapshot["stages"].items()):
+        label = 'stage="' + escapeLabel(name) + '"'
+        cumulative = 0
+        for bound, count in zip(stageBuckets, stage["buckets"]):
+            cumulative += count
+            lines.append("datacheck_stage_seconds_bucket{" + label + ',le="' + str(bound) + '"} ' + str(cumulative))
+        lines.append("datacheck_stage_seconds_bucket{" + label + ',le="+Inf"} ' + str(stage["count"]))
+        lines.append("datacheck_stage_seconds_sum{" + label + "} " + repr(stage["sum"]))
+        lines.append("datacheck_stage_seconds_count{" + label + "} " + str(stage["count"]))
+    
+    lines.append("# TYPE datacheck_events_total counter")
+    for name, value in sorted(snapshot["counters"].items()):
+        lines.append('datacheck_events_total{event="' + escapeLabel(name) + '"} ' + str(value))
+    
+    lines.append("# TYPE datacheck_failures_total counter")
+    for kind, value in sorted(snapshot["failures"].items()):
+        lines.append('datacheck_failures_total{kind="' + escapeLabel(kind) + '"} ' + str(value))
+    
+    lines.append("# TYPE datacheck_http_requests_total counter")
+    for host, stats in sorted(snapshot["hosts"].items()):
+        for key in ["requests", "retries", "errors", "throttled"]:
+            lines.append('datacheck_http_requests_total{host="' + escapeLabel(host) + '",result="' + key + '"} ' + str(stats.get(key, 0)))
+    
+    lines.append("# TYPE datacheck_http_host_limit gauge")
+    for host, stats in sorted(snapshot["hosts"].items()):
+        if "limit" in stats:
+            lines.append('datacheck_http_host_limit{host="' + escapeLabel(host) + '"} ' + str(stats["limit"]))
+    
+    lines.append("# TYPE datacheck_cache_total counter")
+    for cache, stats in sorted(snapshot["caches"].items()):
+        for key, value in sorted(stats.items()):
+            lines.append('datacheck_cache_total{cache="' + cache + '",result="' + key + '"} ' + str(value))
+    
+    return "\n".join(lines) + "\n"
+
+def writeMetrics():
+    snapshot = getMetrics()
+    for fileName, data in [(metricsFile, lambda: json.dumps(snapshot, ensure_ascii = False, indent = 2)),
+                           (prometheusFile, lambda: formatPrometheus(snapshot))]:
+        if not fileName:
+            continue
+        directory = os.path.dirname(fileName)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        writeFileAtomic(fileName, data().encode("utf-8"))
+
+
+
+# -----------------------------------------------
+
+
+
+hostLimiters = {}
+hostLimitersLock = threading.Lock()
+
+class HostThrottled(requests.exceptions.RequestException):
+    pass
+
+class HostLimiter:
+    # вежливость к одному хосту: ведро токенов (hostRate запросов в секунду),
+    # пауза по Retry-After и окно одновременных запросов по схеме AIMD:
+    # +1 за окно успешных ответов, вдвое меньше при 429/503, обрывах и росте задержки
+    
+    def __init__(self, host):
+        self.host = host
+        self.condition = threading.Condition()
+        self.rate = hostRates.get(host, hostRate)
+        self.tokens = float(hostBurst)
+        self.updated = time.monotonic()
+        self.limit = float(min(hostStartConcurrency, maxRequestsPerHost))
+        self.active = 0
+        self.blockedUntil = 0.0
+        self.latency = None
+        self.baseLatency = None
+        self.lastDecrease = 0.0
+    
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(float(hostBurst), self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def acquire(self):
+        # ждём только свой хост: остановленный хост не держит запросы к другим
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                if self.blockedUntil > now:
+                    if self.blockedUntil - now > httpMaxRetryAfter:
+                        raise HostThrottled(self.host + ": Retry-After " + str(round(self.blockedUntil - now)) + " с")
+                    wait = self.blockedUntil - now
+                elif self.active >= int(self.limit):
+                    wait = None
+                elif self.rate and self.tokens < 1:
+                    wait = (1 - self.tokens) / self.rate
+                else:
+                    self.active += 1
+                    if self.rate:
+                        self.tokens -= 1
+                    return
+                self.condition.wait(wait)
+    
+    def release(self, latency = None, throttled = False, retryAfter = None):
+        with self.condition:
+            self.active -= 1
+            now = time.monotonic()
+            
+            if retryAfter is not None:
+                self.blockedUntil = max(self.blockedUntil, now + retryAfter)
+            
+            congested = throttled
+            if latency is not None and not throttled:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+                if self.baseLatency is None or self.latency < self.baseLatency:
+                    self.baseLatency = self.latency
+                congested = self.latency > hostLatencyFactor * max(self.baseLatency, 0.05)
+            
+            if congested:
+                # не чаще раза за время ответа: пачка ошибок от одного окна - одно снижение
+                if now - self.lastDecrease > (self.latency or 1.0):
+                    self.limit = max(1.0, self.limit / 2)
+                    self.lastDecrease = now
+            else:
+                self.limit = min(float(maxRequestsPerHost), self.limit + 1 / self.limit)
+            
+            self.condition.notify_all()
+
+def getHost(url):
+    return (urlparse(url).hostname or "").lower()
+
+def getHostLimiter(url):
+    host = getHost(url)
+    with hostLimitersLock:
+        limiter = hostLimiters.get(host)
+        if limiter is None:
+            limiter = HostLimiter(host)
+            hostLimiters[host] = limiter
+    return limiter
+
+def getRetryAfter(response):
+    # секунды или HTTP-дата
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+httpSession = None
+httpSessionLock = threading.Lock()
+httpStats = {}
+httpStatsLock = threading.Lock()
+
+def getSession():
+    global httpSession
+    with httpSessionLock:
+        if httpSession is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections = httpPoolHosts,
+                pool_maxsize = maxRequestsPerHost
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            httpSession = session
+    return httpSession
+
+def countHost(url, key):
+    host = getHost(url)
+    with httpStatsLock:
+        stats = httpStats.setdefault(host, {"requests": 0, "retries": 0, "errors": 0, "throttled": 0})
+        stats[key] += 1
+
+def httpRequest(method, url, **kwargs):
+    kwargs.setdefault("timeout", httpTimeout)
+    # GET/HEAD повторяем при сбоях, остальные - только если сервер отказал
+    # до обработки (429/503)
+    idempotent = method in ("GET", "HEAD")
+    limiter = getHostLimiter(url)
+    attempt = 0
+    while True:
+        limiter.acquire()
+        countHost(url, "requests")
+        try:
+            response = getSession().request(method, url, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            limiter.release(throttled = True)
+            if not idempotent or attempt >= httpRetries:
+                countHost(url, "errors")
+                raise
+            retryAfter = None
+        except BaseException:
+            # любой другой сбой (редиректы, неверный URL...) - слот
+            # возвращаем, иначе остальные потоки повиснут в acquire
+            limiter.release()
+            countHost(url, "errors")
+            raise
+        else:
+            throttled = response.status_code in httpThrottleStatuses
+            retryAfter = getRetryAfter(response) if throttled else None
+            latency = response.elapsed.total_seconds()
+            if throttled:
+                countHost(url, "throttled")
+            
+            retry = response.status_code in httpRetryStatuses if idempotent else throttled
+            # долгая пауза: отдаём ответ, остальные запросы к хосту получат HostThrottled
+            if not retry or attempt >= httpRetries or (retryAfter is not None and retryAfter > httpMaxRetryAfter):
+                if kwargs.get("stream") and not throttled:
+                    holdHostSlot(response, limiter, latency)
+                else:
+                    limiter.release(latency, throttled, retryAfter)
+                return response
+            limiter.release(latency, throttled, retryAfter)
+            response.close()
+        
+        attempt += 1
+        countHost(url, "retries")
+        # тело запроса из файла перечитывается с начала
+        data = kwargs.get("data")
+        if hasattr(data, "seek"):
+            data.seek(0)
+        # при Retry-After ждёт limiter.acquire, без него - экспоненциальная пауза
+        if retryAfter is None:
+            time.sleep(httpBackoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+def holdHostSlot(response, limiter, latency):
+    # тело потокового ответа читается уже после возврата из httpRequest:
+    # место в окне хоста занято, пока ответ не закрыт; задержка для AIMD -
+    # до заголовков, время тела зависит от размера файла
+    close = response.close
+    released = []
+    
+    def closeAndRelease():
+        try:
+            close()
+        finally:
+            if not released:
+                released.append(True)
+                limiter.release(latency)
+    
+    response.close = closeAndRelease
+
+def httpGet(url, **kwargs):
+    return httpRequest("GET", url, **kwargs)
+
+def httpHead(url, **kwargs):
+    kwargs.setdefault("allow_redirects", True)
+    return httpRequest("HEAD", url, **kwargs)
+
+def httpPost(url, **kwargs):
+    return httpRequest("POST", url, **kwargs)
+
+def getHostStats():
+    with httpStatsLock:
+        stats = {host: dict(values) for host, values in httpStats.items()}
+    
+    if httpSession is not None:
+        for adapter in set(httpSession.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                values = stats.setdefault(pool.host, {"requests": 0, "retries": 0, "errors": 0, "throttled": 0})
+                values["connections"] = values.get("connections", 0) + pool.num_connections
+    
+    with hostLimitersLock:
+        limiters = list(hostLimiters.values())
+    for limiter in limiters:
+        values = stats.setdefault(limiter.host, {"requests": 0, "retries": 0, "errors": 0, "throttled": 0})
+        values["limit"] = int(limiter.limit)
+    
+    return stats
+
+def printHostStats():
+    for host, stats in sorted(getHostStats().items()):
+        log.info("%s: запросов %d, соединений %d, повторов %d, ошибок %d, отказов 429/503 %d, окно %d",
+                 host, stats["requests"], stats.get("connections", 0), stats["retries"], stats["errors"],
+                 stats["throttled"], stats.get("limit", 0))
+
+httpCacheStats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+httpCacheBytes = None
+httpCacheLock = threading.RLock()
+
+def countHttpCache(key):
+    with httpCacheLock:
+        httpCacheStats[key] += 1
+
+def writeFileAtomic(filePath, data):
+    tempPath = filePath + "." + str(threading.get_ident()) + ".part"
+    with open(tempPath, "wb") as file:
+        file.write(data)
+    os.replace(tempPath, filePath)
+
+def getHttpCachePaths(url):
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    directory = os.path.join(cacheDir, "http")
+    return directory, os.path.join(directory, key + ".body"), os.path.join(directory, key + ".json")
+
+def evictLeastRecent(directory, suffix, maxBytes, exclude = ()):
+    # удаляем давно не использованные файлы, пока каталог не влезет в лимит;
+    # время использования - mtime, его обновляет os.utime при попадании.
+    # Файлы из exclude занимают место, но не удаляются
+    entries = []
+    excluded = 0
+    for name in os.listdir(directory):
+        if name.endswith(suffix) and not name.endswith(".part"):
+            path = os.path.join(directory, name)
+            if path in exclude:
+                try:
+                    excluded += os.path.getsize(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    
+    total = excluded + sum(entry[1] for entry in entries)
+    removed = []
+    for mtime, size, path in sorted(entries):
+        if total <= maxBytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+        removed.append(path)
+    return total, removed
+
+def evictHttpCache(directory):
+    total, removed = evictLeastRecent(directory, ".body", httpCacheMaxBytes)
+    for bodyPath in removed:
+        try:
+            os.remove(bodyPath[:-len(".body")] + ".json")
+        except OSError:
+            pass
+        countHttpCache("evicted")
+    return total
+
+def storeHttpCache(url, response):
+    global httpCacheBytes
+    directory, bodyPath, metaPath = getHttpCachePaths(url)
+    meta = {
+        "url":          url,
+        "etag":         response.headers.get("ETag"),
+        "lastModified": response.headers.get("Last-Modified"),
+        "encoding":     response.encoding or response.apparent_encoding,
+        "size":         len(response.content),
+    }
+    
+    os.makedirs(directory, exist_ok = True)
+    oldSize = os.path.getsize(bodyPath) if os.path.isfile(bodyPath) else 0
+    writeFileAtomic(bodyPath, response.content)
+    writeFileAtomic(metaPath, json.dumps(meta).encode("utf-8"))
+    countHttpCache("stored")
+    
+    with httpCacheLock:
+        if httpCacheBytes is None:
+            httpCacheBytes = evictHttpCache(directory)
+        else:
+            httpCacheBytes += meta["size"] - oldSize
+            if httpCacheBytes > httpCacheMaxBytes:
+                httpCacheBytes = evictHttpCache(directory)
+
+def cachedGet(url):
+    # GET с условной перепроверкой: неизменившийся ответ стоит 304 вместо тела
+    if not useHttpCache:
+        r = httpGet(url)
+        return r.status_code, r.text
+    
+    directory, bodyPath, metaPath = getHttpCachePaths(url)
+    
+    meta = None
+    headers = {}
+    if os.path.isfile(metaPath) and os.path.isfile(bodyPath):
+        try:
+            with open(metaPath, "r", encoding="utf-8") as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            meta = None
+    if meta is not None:
+        if meta["etag"]:
+            headers["If-None-Match"] = meta["etag"]
+        if meta["lastModified"]:
+            headers["If-Modified-Since"] = meta["lastModified"]
+    
+    r = httpGet(url, headers = headers)
+    
+    if r.status_code == 304 and meta is not None:
+        try:
+            with open(bodyPath, "rb") as file:
+                body = file.read()
+            os.utime(bodyPath)
+        except OSError:
+            body = None
+        if body is not None:
+            countHttpCache("hits")
+            return 200, body.decode(meta["encoding"] or "utf-8", errors="replace")
+        r = httpGet(url)
+    
+    countHttpCache("misses")
+    countMetric("bytes_fetched", len(r.content))
+    if r.status_code == 200 and (r.headers.get("ETag") or r.headers.get("Last-Modified")):
+        try:
+            storeHttpCache(url, r)
+        except OSError as e:
+            log.warning("не удалось сохранить ответ в кэш: %s", e)
+            countFailure("http_cache_store")
+    return r.status_code, r.text
+
+def streamDownload(url, filePath, name, headers = None):
+    # файл пишется кусками во временный и переименовывается только целиком,
+    # в памяти держится один кусок
+    response = httpGet(url, stream = True, headers = headers)
+    try:
+        if response.status_code == 304:
+            return {"status": 304}
+        if response.status_code != 200:
+            return None
+        
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > maxDownloadBytes:
+            log.warning("файл слишком большой: %s [%s]", name, getReadableSize(int(length)))
+            return None
+        
+        directory = os.path.dirname(filePath)
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        tempPath = filePath + "." + str(threading.get_ident()) + ".part"
+        
+        written = 0
+        reported = 0
+        digest = hashlib.sha256()
+        try:
+            with open(tempPath, "wb") as file:
+                for chunk in response.iter_content(chunk_size = downloadChunkSize):
+                    file.write(chunk)
+                    digest.update(chunk)
+                    written += len(chunk)
+                    if written > maxDownloadBytes:
+                        log.warning("файл слишком большой: %s [%s]", name, getReadableSize(written))
+                        break
+                    if written - reported >= downloadProgressStep:
+                        reported = written
+                        log.debug("скачивается: %s [%s]", name, getReadableSize(written))
+        except BaseException:
+            os.remove(tempPath)
+            raise
+        
+        if written > maxDownloadBytes:
+            os.remove(tempPath)
+            return None
+        os.replace(tempPath, filePath)
+        countMetric("bytes_downloaded", written)
+        return {
+            "status":       200,
+            "size":         written,
+            "hash":         digest.hexdigest(),
+            "contentType":  response.headers.get("Content-Type"),
+            "etag":         response.headers.get("ETag"),
+            "lastModified": response.headers.get("Last-Modified"),
+        }
+    finally:
+        response.close()
+
+downloadCacheStats = {"hits": 0, "misses": 0, "revalidated": 0, "deduplicated": 0, "corrupted": 0, "evicted": 0}
+downloadCacheBytes = None
+downloadCacheLock = threading.RLock()
+
+# объекты кэша, которые скачаны и ещё профилируются: путь -> число пользователей
+downloadsInUse = {}
+
+def countDownloadCache(key):
+    with downloadCacheLock:
+        downloadCacheStats[key] += 1
+
+def holdDownload(objectPath):
+    # объект не вытесняется, пока его не отпустят releaseDownload;
+    # False - объекта уже нет
+    with downloadCacheLock:
+        try:
+            os.utime(objectPath)
+        except OSError:
+            return False
+        downloadsInUse[objectPath] = downloadsInUse.get(objectPath, 0) + 1
+        return True
+
+def releaseDownload(objectPath):
+    with downloadCacheLock:
+        downloadsInUse[objectPath] -= 1
+        if not downloadsInUse[objectPath]:
+            del downloadsInUse[objectPath]
+
+def getDownloadCachePaths(url):
+    # index/<sha256 ссылки>.json -> objects/<sha256 содержимого>,
+    # одинаковые файлы разных датасетов хранятся один раз
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    directory = os.path.join(cacheDir, "downloads")
+    return os.path.join(directory, "objects"), os.path.join(directory, "index", key + ".json")
+
+def hashFile(filePath):
+    digest = hashlib.sha256()
+    with open(filePath, "rb") as file:
+        for chunk in iter(lambda: file.read(downloadChunkSize), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def isObjectIntact(objectPath, meta):
+    try:
+        if os.path.getsize(objectPath) != meta["size"]:
+            return False
+        if verifyDownloadCache and hashFile(objectPath) != meta["hash"]:
+            return False
+    except OSError:
+        return False
+    return True
+
+def cachedDownload(url, name):
+    global downloadCacheBytes
+    objectsDir, metaPath = getDownloadCachePaths(url)
+    
+    meta = None
+    if os.path.isfile(metaPath):
+        try:
+            with open(metaPath, "r", encoding="utf-8") as file:
+                meta = json.load(file)
+        except (OSError, ValueError):
+            meta = None
+    
+    headers = {}
+    if meta is not None:
+        objectPath = os.path.join(objectsDir, meta["hash"])
+        if not os.path.isfile(objectPath):
+            meta = None
+        elif not isObjectIntact(objectPath, meta):
+            log.warning("файл в кэше повреждён: %s", name)
+            countDownloadCache("corrupted")
+            os.remove(objectPath)
+            meta = None
+        elif time.time() - meta["fetchedAt"] < downloadCacheMaxAge:
+            if holdDownload(objectPath):
+                countDownloadCache("hits")
+                return objectPath, meta
+            # вытеснен другим потоком после проверки
+            meta = None
+        else:
+            if meta["etag"]:
+                headers["If-None-Match"] = meta["etag"]
+            if meta["lastModified"]:
+                headers["If-Modified-Since"] = meta["lastModified"]
+    
+    os.makedirs(objectsDir, exist_ok = True)
+    os.makedirs(os.path.dirname(metaPath), exist_ok = True)
+    # недокачанный файл лежит вне objects/, чтобы его не вытеснили
+    incomingDir = os.path.join(os.path.dirname(objectsDir), "incoming")
+    os.makedirs(incomingDir, exist_ok = True)
+    incomingPath = os.path.join(incomingDir, str(threading.get_ident()))
+    
+    download = streamDownload(url, incomingPath, name, headers)
+    if download is None:
+        return None, None
+    
+    if download["status"] == 304:
+        objectPath = os.path.join(objectsDir, meta["hash"])
+        if not holdDownload(objectPath):
+            # объект вытеснили, пока шла перепроверка: индекс указывает
+            # на пустое место, повторный вызов скачает файл целиком
+            return cachedDownload(url, name)
+        countDownloadCache("revalidated")
+    else:
+        countDownloadCache("misses")
+        objectPath = os.path.join(objectsDir, download["hash"])
+        with downloadCacheLock:
+            if holdDownload(objectPath):
+                countDownloadCache("deduplicated")
+                os.remove(incomingPath)
+            else:
+                os.replace(incomingPath, objectPath)
+                holdDownload(objectPath)
+                if downloadCacheBytes is not None:
+                    downloadCacheBytes += download["size"]
+        meta = {
+            "url":          url,
+            "hash":         download["hash"],
+            "size":         download["size"],
+            "contentType":  download["contentType"],
+            "etag":         download["etag"],
+            "lastModified": download["lastModified"],
+        }
+    
+    meta["fetchedAt"] = time.time()
+    writeFileAtomic(metaPath, json.dumps(meta).encode("utf-8"))
+    
+    with downloadCacheLock:
+        if downloadCacheBytes is None or downloadCacheBytes > downloadCacheMaxBytes:
+            # файлы, которые ещё профилируются, остаются до releaseDownload;
+            # лишнее место освободится при следующем скачивании
+            downloadCacheBytes, removed = evictLeastRecent(objectsDir, "", downloadCacheMaxBytes, downloadsInUse)
+            for path in removed:
+                countDownloadCache("evicted")
+    
+    return objectPath, meta
+
+def sniffZip(head):
+    # имена файлов из локальных заголовков в начале архива
+    names = []
+    position = 0
+    while position + 30 <= len(head) and head[position:position + 4] == b"PK\x03\x04":
+        compressedSize, _, nameLength, extraLength = struct.unpack("<IIHH", head[position + 18:position + 30])
+        name = head[position + 30:position + 30 + nameLength].decode("utf-8", "replace")
+        names.append(name)
+        if name == "mimetype":
+            # ODF кладёт тип документа первым несжатым файлом
+            start = position + 30 + nameLength + extraLength
+            if b"opendocument.spreadsheet" in head[start:start + compressedSize]:
+                return "ODS"
+        flags = struct.unpack("<H", head[position + 6:position + 8])[0]
+        if flags & 0x08:
+            # размер записан после данных, дальше не пройти
+            break
+        position += 30 + nameLength + extraLength + compressedSize
+    
+    if any(n.startswith("xl/") for n in names):
+        return "XLSX"
+    if any(n.startswith("word/") for n in names):
+        return "DOCX"
+    if any(n.lower().endswith(".kml") for n in names):
+        return "KMZ"
+    if any(n.lower().endswith(".shp") for n in names):
+        return "SHP"
+    if "[Content_Types].xml" in names:
+        # заголовок xl/ не поместился в пробу
+        return "XLSX"
+    return "ZIP"
+
+def decodeHead(head):
+    for encoding in ["utf-8", "cp1251"]:
+        try:
+            # последний символ мог обрезаться на границе пробы
+            return head.decode(encoding)
+        except UnicodeDecodeError as e:
+            if encoding == "utf-8" and e.start >= len(head) - 3:
+                return head[:e.start].decode(encoding)
+    return head.decode("latin-1")
+
+def sniffText(text, complete):
+    # {"format": None} - содержимое не опознано, остаётся подпись каталога
+    start = text.lstrip("\ufeff \t\r\n")[:1024].lower()
+    
+    if start.startswith("<"):
+        # теги HTML ищем только в разметке: в CSV "<body>" может стоять в ячейке
+        if not start.startswith("<?xml") and re.search(r"^<!doctype html|<(html|head|body)[\s>]", start[:256]):
+            return {"format": "HTML"}
+        if "<kml" in start:
+            return {"format": "KML"}
+        if "<rdf:rdf" in start:
+            return {"format": "RDF_XML"}
+        return {"format": "XML"}
+    if start.startswith("{") or start.startswith("["):
+        try:
+            json.loads(text)
+        except ValueError:
+            # обрезанный на границе пробы JSON не разобрать целиком
+            if complete:
+                return {"format": None}
+        if '"featurecollection"' in start.replace(" ", "") or '"type":"feature"' in start.replace(" ", ""):
+            return {"format": "GEOJSON"}
+        return {"format": "JSON"}
+    
+    lines = text.splitlines()
+    if not complete:
+        lines = lines[:-1]
+    lines = [line for line in lines[:sniffLines] if line.strip()]
+    if len(lines) < 2:
+        return {"format": None}
+    # разделитель без проверки числа полей: строки разной длины и CSV из одного
+    # столбца (без разделителя) профилируются по подписи каталога
+    try:
+        delimiter = csv.Sniffer().sniff("\n".join(lines), delimiters = ",;\t|").delimiter
+    except csv.Error:
+        # Sniffer ждёт одинакового числа полей; для неровных строк -
+        # самый частый в заголовке разделитель, если он есть в большинстве строк
+        delimiter = max(",;\t|", key = lines[0].count)
+        if lines[0].count(delimiter) == 0 or sum(delimiter in line for line in lines) * 2 <= len(lines):
+            return {"format": None}
+    return {"format": "TSV" if delimiter == "\t" else "CSV", "delimiter": delimiter}
+
+def sniffData(head, complete):
+    # формат по первым байтам: сигнатура, для текста - структура
+    if head.startswith(b"PK\x03\x04"):
+        return {"format": sniffZip(head)}
+    if head.startswith(b"PK\x05\x06"):
+        return {"format": "ZIP"}
+    if head.startswith(b"\x1f\x8b"):
+        return {"format": "GZIP"}
+    if head.startswith(b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"):
+        return {"format": "XLS"}
+    if head.startswith(b"%PDF"):
+        return {"format": "PDF"}
+    if head.startswith(b"\x89PNG"):
+        return {"format": "PNG"}
+    if head.startswith(b"\xff\xd8\xff"):
+        return {"format": "JPEG"}
+    if b"\x00" in head[:1024]:
+        return {"format": None}
+    if not head.strip():
+        return {"format": None}
+    return sniffText(decodeHead(head), complete)
+
+def readProbe(url):
+    # первые probeBytes байт: Range, а если сервер его не понимает -
+    # чтение ответа 200 обрывается на том же пределе
+    response = httpGet(url, stream = True, headers = {"Range": "bytes=0-" + str(probeBytes - 1)})
+    try:
+        if response.status_code not in (200, 206):
+            return response.status_code, None, None, False
+        head = b""
+        for chunk in response.iter_content(chunk_size = probeBytes):
+            head += chunk
+            if len(head) >= probeBytes:
+                break
+        complete = len(head) < probeBytes
+        countMetric("bytes_probed", len(head))
+        return response.status_code, head[:probeBytes], response.headers.get("Content-Type"), complete
+    finally:
+        response.close()
+
+def readCachedProbe(url):
+    # свежий файл из кэша скачиваний читается с диска
+    objectsDir, metaPath = getDownloadCachePaths(url)
+    try:
+        with open(metaPath, "r", encoding="utf-8") as file:
+            meta = json.load(file)
+        if time.time() - meta["fetchedAt"] >= downloadCacheMaxAge:
+            return None
+        with open(os.path.join(objectsDir, meta["hash"]), "rb") as file:
+            head = file.read(probeBytes)
+    except (OSError, ValueError, KeyError):
+        return None
+    return head, meta["contentType"], meta["size"] <= probeBytes
+
+def probeDataFile(link):
+    url = link[1]
+    
+    cached = readCachedProbe(url)
+    if cached is not None:
+        head, contentType, complete = cached
+    else:
+        try:
+            status, head, contentType, complete = readProbe(url)
+        except requests.exceptions.RequestException as e:
+            log.warning("не удалось проверить ссылку: %s", link[0])
+            countFailure("download_" + type(e).__name__)
+            return None
+        if head is None:
+            log.warning("не удалось проверить ссылку: %s [%s]", link[0], status)
+            countFailure("download_status_" + str(status))
+            return None
+    
+    probe = sniffData(head, complete)
+    if probe["format"] is None and contentType and contentType.startswith("text/html"):
+        probe["format"] = "HTML"
+    probe["label"] = (link[0] or "").upper()
+    return probe
+
+def getProbeFormat(link, probe):
+    # формат по содержимому, а если он не опознан или ссылка не проверена - подпись каталога
+    if probe is not None and probe["format"] is not None:
+        return probe["format"]
+    return (link[0] or "").upper()
+
+def probeDownloadLinks(downloadLinks):
+    probes = {}
+    for link in downloadLinks:
+        if link[1] and link[1] not in probes:
+            probes[link[1]] = probeDataFile(link)
+    return probes
+
+def fetchDataFile(link, probe = None):
+    if probe is None:
+        probe = probeDataFile(link)
+        if probe is None:
+            return None
+    if probe["format"] == "HTML":
+        log.warning("по ссылке на скачивание нет файла: %s", link[0])
+        countFailure("download_html")
         return None
-    return title.text.strip()
-
-def findDataInTable(soup, data):
-    header = soup.find("th", string = data)
-    if header is not None:
-        row = header.parent
-        value = row.find("td")
-        if value is not None:
-            return value.text.strip()
+    
+    url = link[1]
+    
+    try:
+        filePath, meta = cachedDownload(url, link[0])
+    except requests.exceptions.RequestException as e:
+        log.warning("не удалось скачать файл: %s", link[0])
+        countFailure("download_" + type(e).__name__)
+        return None
+    
+    if filePath is None:
+        log.warning("не удалось скачать файл: %s", link[0])
+        countFailure("download_rejected")
+        return None
+    
+    log.info("файл получен: %s [%s]", link[0], getReadableSize(meta["size"]))
+    return filePath
+
+def fetchDataHead(link, lines):
+    # первые lines строк файла без скачивания остального; нужен Content-Length
+    # без сжатия, иначе оценивать число строк не по чему - тогда None
+    url = link[1]
+    directory = os.path.join(cacheDir, "heads")
+    os.makedirs(directory, exist_ok = True)
+    filePath = os.path.join(directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + "-" + str(threading.get_ident()))
+    
+    try:
+        response = httpGet(url, stream = True)
+    except requests.exceptions.RequestException as e:
+        log.warning("не удалось скачать начало файла: %s", link[0])
+        countFailure("download_" + type(e).__name__)
+        return None
+    try:
+        length = response.headers.get("Content-Length")
+        if response.status_code != 200 or not length or not length.isdigit() or response.headers.get("Content-Encoding"):
+            return None
+        
+        written = 0
+        found = 0
+        with open(filePath, "wb") as file:
+            for chunk in response.iter_content(chunk_size = probeBytes):
+                position = -1
+                while found < lines:
+                    position = chunk.find(b"\n", position + 1)
+                    if position < 0:
+                        break
+                    found += 1
+                if found >= lines:
+                    chunk = chunk[:position + 1]
+                file.write(chunk)
+                written += len(chunk)
+                if found >= lines:
+                    break
+    except BaseException:
+        if os.path.exists(filePath):
+            os.remove(filePath)
+        raise
+    finally:
+        response.close()
+    
+    countMetric("bytes_downloaded", written)
+    log.info("начало файла получено: %s [%s из %s]", link[0], getReadableSize(written), getReadableSize(int(length)))
+    return filePath, int(length)
+
+def printHttpCacheStats():
+    if not useHttpCache:
+        return
+    log.info("http-кэш: попаданий %(hits)d, промахов %(misses)d, сохранено %(stored)d, вытеснено %(evicted)d",
+             httpCacheStats)
+
+def printDownloadCacheStats():
+    log.info("кэш файлов: попаданий %(hits)d, промахов %(misses)d, перепроверено %(revalidated)d, "
+             "дубликатов %(deduplicated)d, повреждено %(corrupted)d, вытеснено %(evicted)d",
+             downloadCacheStats)
+
+def printDCATAPCacheStats():
+    log.info("кэш проверок DCAT-AP: попаданий %(hits)d, промахов %(misses)d, сохранено %(stored)d, просрочено %(expired)d",
+             dcatapCacheStats)
+
+def printStageStats():
+    for name, stage in sorted(getMetrics()["stages"].items()):
+        log.info("этап %s: %d раз, всего %.2f с, в среднем %.3f с, максимум %.3f с",
+                 name, stage["count"], stage["sum"], stage["mean"], stage["max"])
+
+def printRunStats():
+    printStageStats()
+    printHostStats()
+    printHttpCacheStats()
+    printDownloadCacheStats()
+    printDCATAPCacheStats()
+
+class ThreadOutput(io.TextIOBase):
+    # stdout, который копит вывод каждого потока отдельно,
+    # чтобы отчёты печатались в порядке входного списка
+    
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+    
+    def write(self, s):
+        buffer = getattr(self.local, "buffer", None)
+        if buffer is None:
+            return self.stream.write(s)
+        return buffer.write(s)
+    
+    def flush(self):
+        self.stream.flush()
+    
+    def capture(self):
+        self.local.buffer = io.StringIO()
+    
+    def release(self):
+        text = self.local.buffer.getvalue()
+        self.local.buffer = None
+        return text
+
+
+
+# -----------------------------------------------
+
+
+
+# этапы проверки датасета: fetch -> extract -> validate -> download -> profile -> report;
+# сеть идёт в потоках checkAll, разбор страниц и профилирование - в пуле процессов
+# по числу ядер, скачанные и ещё не профилированные файлы ограничены maxPendingFiles
+
+cpuPool = None
+cpuPoolLock = threading.Lock()
+pendingFiles = None
+ioSlots = None
+ioSlotHeld = threading.local()
+
+# настройки, которые нужны процессам пула
+cpuSettings = [
+    "catalogUrl", "logLevel",
+    "profileChunkRows", "profilingMode", "hllPrecision", "quantileSampleSize",
+    "sampleRows", "sampleMethod", "useTypedCsv", "schemaScanRows",
+    "categoryMaxUnique", "csvEngine", "dcatapShapesFile",
+]
+
+def getCpuWorkers():
+    return cpuWorkers if cpuWorkers is not None else os.cpu_count() or 1
+
+def initCpuWorker(settings):
+    globals().update(settings)
+    setupLogging()
+
+def getCpuPool():
+    global cpuPool
+    with cpuPoolLock:
+        if cpuPool is None and getCpuWorkers() > 0:
+            # spawn: дочерний процесс не наследует замки потоков родителя
+            cpuPool = ProcessPoolExecutor(
+                max_workers = getCpuWorkers(),
+                mp_context = multiprocessing.get_context("spawn"),
+                initializer = initCpuWorker,
+                initargs = ({name: globals()[name] for name in cpuSettings},)
+            )
+    return cpuPool
+
+def shutdownCpuPool():
+    global cpuPool
+    with cpuPoolLock:
+        if cpuPool is not None:
+            cpuPool.shutdown()
+            cpuPool = None
+
+def runCaptured(function, args):
+    output = io.StringIO()
+    with redirect_stdout(output):
+        result = function(*args)
+    return result, output.getvalue()
+
+def runCpu(function, *args):
+    # вывод процесса возвращается вместе с результатом и печатается
+    # в потоке датасета, чтобы не перемешаться с чужим
+    pool = getCpuPool()
+    if pool is None:
+        return function(*args)
+    future = pool.submit(runCaptured, function, args)
+    with ioSlotReleased():
+        result, text = future.result()
+    sys.stdout.write(text)
+    return result
+
+@contextmanager
+def ioSlot():
+    # сетевой работой одновременно заняты maxWorkers потоков; потоков проверки
+    # больше на число процессов пула, и пока одни ждут профилирования,
+    # остальные скачивают - процессы загружены независимо от maxWorkers
+    if ioSlots is None:
+        yield
+        return
+    ioSlots.acquire()
+    ioSlotHeld.value = True
+    try:
+        yield
+    finally:
+        ioSlotHeld.value = False
+        ioSlots.release()
+
+@contextmanager
+def ioSlotReleased():
+    # на время ожидания пула или очереди файлов место отдаётся другому потоку
+    if ioSlots is None or not getattr(ioSlotHeld, "value", False):
+        yield
+        return
+    ioSlotHeld.value = False
+    ioSlots.release()
+    try:
+        yield
+    finally:
+        ioSlots.acquire()
+        ioSlotHeld.value = True
+
+def getCheckThreads():
+    if getCpuWorkers() > 0:
+        return maxWorkers + getCpuWorkers()
+    return maxWorkers
+
+@contextmanager
+def pendingFileSlot():
+    # обратное давление: скачивание ждёт, пока профилирование не разгрузится
+    global pendingFiles
+    with cpuPoolLock:
+        if pendingFiles is None:
+            pendingFiles = threading.BoundedSemaphore(maxPendingFiles or 2 * max(getCpuWorkers(), 1))
+    with ioSlotReleased():
+        pendingFiles.acquire()
+    try:
+        yield
+    finally:
+        pendingFiles.release()
+
+@contextmanager
+def timeStage(timings, name):
+    # время копится в timings датасета; в метрики этапов оно попадает
+    # один раз за датасет, в конце checkOne
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        timings[name] = timings.get(name, 0.0) + seconds
+
+def getPageParser():
+    try:
+        import lxml
+        return "lxml"
+    except ImportError:
+        return "html.parser"
+
+def indexPage(html):
+    # один разбор страницы и один проход по дереву,
+    # дальше все проверки читают готовую запись
+    soup = bs(html, getPageParser())
+    
+    page = {
+        "title":         None,
+        "table":         {},
+        "formats":       [],
+        "sourceFormats": [],
+        "sourceUrl":     None,
+        "downloadLinks": [],
+        "contact":       None,
+        "publisher":     None,
+        "licenseTag":    None,
+        "distributions": None,
+    }
+    resourcesFound = False
+    sourceFound = False
+    
+    for tag in soup.find_all(["h1", "th", "section", "a", "strong"]):
+        if tag.name == "h1":
+            if page["title"] is None and tag.get("itemprop") == "name":
+                page["title"] = tag.text.strip()
+        
+        elif tag.name == "th":
+            header = tag.string
+            if header is not None and header not in page["table"]:
+                value = tag.parent.find("td")
+                page["table"][header] = value.text.strip() if value is not None else None
+        
+        elif tag.name == "section":
+            if tag.get("id") == "dataset-resources" and not resourcesFound:
+                resourcesFound = True
+                for span in tag.find_all("span", class_ = "format-label"):
+                    page["formats"].append(span.text)
+                for button in tag.find_all("i", class_ = "fa fa-download"):
+                    link = button.parent
+                    page["downloadLinks"].append((link.get("data-format"), link.get("href")))
+            
+            elif tag.get("id") == "dataset-metadata-source" and not sourceFound:
+                sourceFound = True
+                for span in tag.find_all("span", class_ = "format-label"):
+                    page["sourceFormats"].append(span.text)
+                link = tag.find("a", string = "Download Metadata")
+                if link is not None and link.get("href"):
+                    page["sourceUrl"] = catalogUrl + link["href"]
+        
+        elif tag.name == "a":
+            if tag.get("title") == "contact" and page["contact"] is None:
+                page["contact"] = tag.get("href", "")
+            elif tag.get("title") == "publsher" and page["publisher"] is None:
+                page["publisher"] = tag.text
+        
+        elif tag.name == "strong":
+            if tag.string == "License:" and page["licenseTag"] is None:
+                l = tag.parent.text.strip()
+                if l.startswith("License:"):
+                    l = l[8:]
+                    l = l.strip()
+                page["licenseTag"] = l
+    
+    return page
+
+def findTitle(page):
+    return page["title"]
+
+def findDataInTable(page, data):
+    return page["table"].get(data)
+
+
+
+# -----------------------------------------------
+
+
+
+ckanPackages = {}
+ckanPackagesLock = threading.Lock()
+
+def getPackageExtra(package, key):
+    for extra in package.get("extras") or []:
+        if extra.get("key") == key:
+            return extra.get("value")
     return None
 
+def indexPackage(package):
+    # запись CKAN package_show/package_search -> та же запись, что и indexPage,
+    # подписи таблицы как на странице датасета
+    table = {}
+    if package.get("license_title"):
+        table["License"] = package["license_title"]
+    if package.get("license_url"):
+        table["License Url"] = package["license_url"]
+    access = getPackageExtra(package, "accessLevel")
+    if access is not None:
+        table["Public Access Level"] = access
+    if package.get("metadata_modified"):
+        table["Metadata Updated Date"] = package["metadata_modified"]
+    
+    contact = package.get("maintainer_email") or getPackageExtra(package, "contact_email")
+    publisher = getPackageExtra(package, "publisher")
+    if publisher is None and package.get("organization"):
+        publisher = package["organization"].get("title")
+    
+    page = {
+        "title":         package.get("title"),
+        "table":         table,
+        "formats":       [],
+        "sourceFormats": [],
+        "sourceUrl":     None,
+        "downloadLinks": [],
+        "contact":       "mailto:" + contact if contact else None,
+        "publisher":     publisher,
+        "licenseTag":    None,
+        "distributions": [],
+    }
+    
+    # медиатипы распространений берутся из ресурсов, data.json не нужен
+    for resource in package.get("resources") or []:
+        format = resource.get("format") or ""
+        page["formats"].append(format)
+        if resource.get("url"):
+            page["downloadLinks"].append((format.lower(), resource["url"]))
+        mediaType = resource.get("mimetype")
+        if mediaType:
+            page["distributions"].append((mediaType, resource.get("url")))
+    
+    return page
+
+def fetchPackageBatch(names):
+    # один package_search на пачку датасетов
+    query = "name:(" + " OR ".join('"' + name + '"' for name in names) + ")"
+    url = ckanApiUrl + "/package_search?" + urlencode({"fq": query, "rows": len(names)})
+    try:
+        r = httpGet(url)
+    except requests.exceptions.RequestException as e:
+        log.warning("package_search не выполнен: %s", e)
+        countFailure("ckan_" + type(e).__name__)
+        return
+    if r.status_code != 200:
+        log.warning("package_search не выполнен: %s", r.status_code)
+        countFailure("ckan_status_" + str(r.status_code))
+        return
+    
+    try:
+        packages = r.json()["result"]["results"]
+        found = [package["name"] for package in packages]
+    except (ValueError, KeyError, TypeError) as e:
+        # пачка пропускается, её датасеты запросятся через package_show
+        log.warning("package_search вернул неверный ответ: %s", e)
+        countFailure("ckan_bad_response")
+        return
+    with ckanPackagesLock:
+        for name, package in zip(found, packages):
+            ckanPackages[name] = package
+    log.debug("package_search: %d из %d", len(found), len(names))
+
+def fetchMissingPackages(batch):
+    # пакеты, уже полученные при поиске датасетов, повторно не запрашиваются
+    with ckanPackagesLock:
+        names = [createId(url) for url in batch if createId(url) not in ckanPackages]
+    if names:
+        fetchPackageBatch(names)
+
+def prefetchPackages(listURL):
+    # метаданные подтягиваются пачками по мере продвижения по списку,
+    # не найденные поиском датасеты потом запрашиваются по одному
+    batch = []
+    for url in listURL:
+        batch.append(url)
+        if len(batch) >= ckanBatchSize:
+            fetchMissingPackages(batch)
+            yield from batch
+            batch = []
+    if batch:
+        fetchMissingPackages(batch)
+        yield from batch
+
+def fetchPackage(url):
+    name = createId(url)
+    with ckanPackagesLock:
+        package = ckanPackages.pop(name, None)
+    
+    if package is None:
+        status, text = cachedGet(ckanApiUrl + "/package_show?id=" + quote(name))
+        if status != 200:
+            return status, text, None
+        try:
+            package = json.loads(text)["result"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise requests.exceptions.RequestException("package_show вернул неверный ответ: " + str(e))
+    
+    text = json.dumps(package, sort_keys = True, ensure_ascii = False)
+    return 200, text, indexPackage(package)
+
+def discardPackage(url):
+    # датасет пропущен без запроса страницы: полученный пачкой пакет больше не нужен
+    with ckanPackagesLock:
+        ckanPackages.pop(createId(url), None)
+
+def makeDatasetUrl(identifier):
+    identifier = identifier.strip()
+    if identifier.startswith("http://") or identifier.startswith("https://"):
+        return identifier
+    return catalogUrl + "/dataset/" + identifier
+
+def readDatasetList(fileName):
+    # по строке на датасет: адрес страницы или имя в каталоге, "-" - stdin
+    file = sys.stdin if fileName == "-" else open(fileName, "r", encoding="utf-8")
+    try:
+        for line in file:
+            if line.strip() and not line.lstrip().startswith("#"):
+                yield makeDatasetUrl(line)
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+def getSearchQuery(organization, tag, modifiedSince):
+    query = []
+    if organization:
+        query.append("organization:" + organization)
+    if tag:
+        query.append('tags:"' + tag + '"')
+    if modifiedSince:
+        query.append("metadata_modified:[" + modifiedSince + " TO *]")
+    return " AND ".join(query) if query else "*:*"
+
+def putPage(pages, item, stop):
+    # очередь ограничена: ждём места, пока потребитель не остановил поиск
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout = 1)
+            return
+        except queue.Full:
+            pass
+
+def searchPackages(query, pages, stop):
+    # фоновая выборка: следующая страница поиска грузится, пока проверяется текущая
+    start = 0
+    try:
+        while not stop.is_set():
+            url = ckanApiUrl + "/package_search?" + urlencode({
+                "fq":    query,
+                "sort":  "metadata_modified asc",
+                "start": start,
+                "rows":  discoveryPageSize,
+            })
+            r = httpGet(url)
+            if r.status_code != 200:
+                raise requests.exceptions.HTTPError("package_search: " + str(r.status_code))
+            # 200 без result/results или с result: null - тоже ошибка поиска
+            packages = r.json()["result"]["results"]
+            if not packages:
+                break
+            putPage(pages, packages, stop)
+            start += len(packages)
+            if len(packages) < discoveryPageSize:
+                break
+    except (requests.exceptions.RequestException, ValueError, KeyError, TypeError) as e:
+        putPage(pages, e, stop)
+    finally:
+        # без конца очереди discoverDatasets ждал бы вечно
+        putPage(pages, None, stop)
+
+def discoverDatasets(organization = None, tag = None, modifiedSince = None):
+    # датасеты каталога постранично; в памяти не больше discoveryPrefetchPages страниц
+    query = getSearchQuery(organization, tag, modifiedSince)
+    pages = queue.Queue(maxsize = discoveryPrefetchPages)
+    stop = threading.Event()
+    threading.Thread(target = searchPackages, args = (query, pages, stop), daemon = True).start()
+    
+    try:
+        while True:
+            packages = pages.get()
+            if packages is None:
+                break
+            if isinstance(packages, Exception):
+                log.warning("поиск датасетов прерван: %s", packages)
+                break
+            for package in packages:
+                # в режиме ckan найденные записи сразу идут в проверку без повторного запроса
+                if metadataSource == "ckan":
+                    with ckanPackagesLock:
+                        ckanPackages[package["name"]] = package
+                yield catalogUrl + "/dataset/" + package["name"]
+    finally:
+        stop.set()
+
+def getDatasetUrls():
+    if discoverySource == "search":
+        return discoverDatasets(discoveryOrganization, discoveryTag, discoveryModifiedSince)
+    if discoverySource is not None:
+        return readDatasetList(discoverySource)
+    return iter(listURL)
+
+def fetchPage(url):
+    if metadataSource == "ckan":
+        return fetchPackage(url)
+    
+    # страница разбирается на этапе extract
+    status, text = cachedGet(url)
+    return status, text, None
+
 def getMediaTypeVocabulary():
     fileName = "MediaTypeVocabulary.txt"
     
@@ -54,7 +1512,7 @@ def getMediaTypeVocabulary():
             return mediaTypeVocabulary
     
     url = "https://www.iana.org/assignments/media-types/media-types.xhtml"
-    r = requests.get(url)
+    r = httpGet(url)
     soup = bs(r.text, "html.parser")
     
     tableT = soup.find_all("th", string = "Template")
@@ -84,7 +1542,7 @@ def getLicencesVocabulary():
             return licencesVocabulary
     
     url = "https://gitlab.com/european-data-portal/edp-vocabularies/-/raw/master/edp-licences-skos.rdf?inline=false"
-    r = requests.get(url)
+    r = httpGet(url)
     soup = bs(r.text, "xml")
     
     licencesVocabulary = []
@@ -102,22 +1560,37 @@ def getLicencesVocabulary():
 
     return licencesVocabulary
 
+def normalizeMediaType(mediaType):
+    # text/csv; charset=utf-8 -> text/csv
+    mediaType = mediaType.split(";")[0].strip().lower()
+    if "/assignments/media-types/" in mediaType:
+        mediaType = mediaType.split("/assignments/media-types/")[1]
+    return mediaType.strip("/")
+
+def normalizeLicense(license):
+    license = " ".join(license.split()).lower()
+    for scheme in ("https://", "http://"):
+        if license.startswith(scheme):
+            license = license[len(scheme):]
+            if license.startswith("www."):
+                license = license[4:]
+            license = license.split("#")[0].rstrip("/")
+            break
+    return license
+
+def makeVocabularyIndex(vocabulary, normalize):
+    return frozenset(normalize(word) for word in vocabulary if word)
+
 
 
 # -----------------------------------------------
 
 
 
-def findFormats(soup):
-    formats = []
-    downloadSection = soup.find("section", id = "dataset-resources")
-    if downloadSection is not None:
-        formatSpans = downloadSection.find_all("span", class_ = "format-label")
-        for format in formatSpans:
-            formats.append(format.text)
-        formats = list(OrderedDict.fromkeys(formats))
+def findFormats(page):
+    formats = list(OrderedDict.fromkeys(page["formats"]))
     
-    print(" @ formats: " + str(formats)) # ////
+    log.debug("formats: %s", formats)
     
     formats = [
         f for f in formats if "Landing Page" != f and "Esri REST" != f
@@ -125,6 +1598,26 @@ def findFormats(soup):
     
     return formats
 
+def findDetectedFormats(formats, downloadLinks, probes):
+    # подписи каталога у проверенных ссылок заменяются форматом по содержимому,
+    # у остальных ресурсов (API, страницы) остаются как есть
+    formats = list(formats)
+    detected = []
+    for link in downloadLinks:
+        probe = probes.get(link[1])
+        if probe is None or probe["format"] is None:
+            continue
+        for f in formats:
+            if f.upper() == probe["label"]:
+                formats.remove(f)
+                break
+        if probe["format"] != probe["label"]:
+            log.info("формат %s по содержимому: %s", link[0], probe["format"])
+            countMetric("formats_mismatched")
+        detected.append(probe["format"])
+    
+    return list(OrderedDict.fromkeys(detected + formats))
+
 def haveFormats(formats):
     if not formats:
         return False
@@ -135,52 +1628,58 @@ def haveFormats(formats):
 
 
 
-def findSourceFormats(soup):
-    formats = []
-    downloadSection = soup.find("section", id = "dataset-metadata-source")
-    if downloadSection is not None:
-        formatSpans = downloadSection.find_all("span", class_ = "format-label")
-        for format in formatSpans:
-            formats.append(format.text)
-        formats = list(OrderedDict.fromkeys(formats))
-    print(" @ source: " + str(formats)) # ////
+def findSourceFormats(page):
+    formats = list(OrderedDict.fromkeys(page["sourceFormats"]))
+    log.debug("source: %s", formats)
     return formats
 
-def findSourceUrl(soup):
-    downloadSection = soup.find("section", id = "dataset-metadata-source")
-    url = None
-    if downloadSection is not None:
-        link = downloadSection.find("a", string = "Download Metadata")
-        link = link["href"]
-        url = "https://catalog.data.gov" + link
-    print(" @ source url: " + str(url)) # ////
+def findSourceUrl(page):
+    url = page["sourceUrl"]
+    log.debug("source url: %s", url)
     return url
 
-def findMediaType(soup):
+def findSourceText(page):
+    # data.json скачивается один раз на страницу
+    if "sourceText" not in page:
+        page["sourceText"] = None
+        
+        url = findSourceUrl(page)
+        if "Data.json" in findSourceFormats(page) and url is not None:
+            try:
+                status, text = cachedGet(url)
+                if status == 200:
+                    page["sourceText"] = text
+                else:
+                    log.warning("data.json не получен: %s [%s]", url, status)
+                    countFailure("datajson_status_" + str(status))
+            except requests.exceptions.RequestException as e:
+                # без data.json проверки неполные, запись повторится в следующий прогон
+                log.warning("data.json не получен: %s", e)
+                countFailure("datajson_" + type(e).__name__)
+    return page["sourceText"]
+
+def findMediaType(page):
     mediaDownloadURL = []
     
-    formatsSource = findSourceFormats(soup)
-    if "Data.json" not in formatsSource:
-        return [], mediaDownloadURL
+    if page["distributions"] is not None:
+        # как в data.json: медиатип считается и без ссылки, скачиваются только ресурсы с url
+        mediaDownloadURL = [(mediaType, url) for mediaType, url in page["distributions"] if url]
+        return [mediaType for mediaType, _ in page["distributions"]], mediaDownloadURL
     
-    url = findSourceUrl(soup)
-    if url is None:
-        return [], mediaDownloadURL
-    
-    r = requests.get(url)
-    if r.status_code != 200:
+    text = findSourceText(page)
+    if text is None:
         return [], mediaDownloadURL
 
     mediaTypes = []
 
-    jd = json.loads(r.text)
+    jd = json.loads(text)
     if "distribution" in jd:
         distr = jd["distribution"]
         for d in distr:
             if "mediaType" in d:
                 mediaTypes.append(d["mediaType"])
         for d in distr:
-            if "mediaType" in d and "downloadURL" in d:
+            if "mediaType" in d and d.get("downloadURL"):
                 mediaDownloadURL.append((d["mediaType"], d["downloadURL"]))
     
     return mediaTypes, mediaDownloadURL
@@ -197,11 +1696,11 @@ def haveMediaTypes(mediaTypes):
 
 def isVocabularyMediaType(mediaTypes, mediaTypeVocabulary):
     if not mediaTypes:
-        print(" @ нет медиа типов") # ////
+        log.debug("нет медиа типов")
         return False
     for mt in mediaTypes:
-        if mt not in mediaTypeVocabulary:
-            print(" @ нет медиа типа: " + mt) # ////
+        if normalizeMediaType(mt) not in mediaTypeVocabulary:
+            log.debug("нет медиа типа: %s", mt)
             return False
     return True
 
@@ -232,78 +1731,271 @@ def isMachineReadableFormats(formats):
 
 
 def downloadData(link, id):
-    url = link[1]
-    
-    response = requests.head(url)
-    content_type = response.headers.get("content-type")
-    if content_type and content_type.startswith("text/html"):
-        print(" @ по ссылке на скачивание нет файла:", link[0]) # ////
-        return None
-    
-    filePath = os.path.join("temp", id + "_" + link[0])
-    filePath = filePath.replace("/", "_")
-    filePath = filePath.replace(".", "_")
-    
-    if os.path.isfile(filePath):
-        print(" @ файл найден на диске:", link[0]) # ////
-        with open(filePath, "r", encoding="utf-8") as file:
-            data = file.read()
-            return data
-    
-    dataReq = requests.get(url)
+    return fetchDataFile(link)
+
+rdfFormats = {
+    "text/turtle":           "turtle",
+    "application/rdf+xml":   "xml",
+    "application/ld+json":   "json-ld",
+    "application/n-triples": "nt",
+    "application/n-quads":   "nquads",
+    "application/trig":      "trig",
+    "text/n3":               "n3",
+}
+
+dcatapShapes = None
+dcatapShapesLock = threading.RLock()
+dcatapLocalVersion = None
+dcatapCacheStats = {"hits": 0, "misses": 0, "stored": 0, "expired": 0}
+dcatapCacheLock = threading.Lock()
+dcatapCachePruned = False
+dcatapFallbackReported = False
+
+def getDCATAPShapes():
+    # формы SHACL лежат в репозитории и разбираются один раз на прогон,
+    # проверка идёт без сети
+    global dcatapShapes
+    with dcatapShapesLock:
+        if dcatapShapes is not None:
+            return dcatapShapes
         
-    if dataReq.status_code != 200:
-        print(" @ не удалось скачать файл:", link[0]) # ////
+        import rdflib
+        
+        shapes = rdflib.Graph()
+        shapes.parse(dcatapShapesFile, format = "turtle")
+        dcatapShapes = shapes
+        log.info("формы DCAT-AP загружены: %d", len(shapes))
+        return dcatapShapes
+
+def validateDCATAPLocal(filePath, mediaType):
+    # то же, что отвечает сервис: не RDF или не разбирается - 400,
+    # иначе отчёт SHACL
+    import rdflib
+    import pyshacl
+    
+    shapes = getDCATAPShapes()
+    
+    format = rdfFormats.get(normalizeMediaType(mediaType))
+    if format is None:
+        return False, "не RDF: " + str(mediaType)
+    
+    data = rdflib.Graph()
+    try:
+        data.parse(filePath, format = format)
+    except Exception as e:
+        return False, "не разбирается: " + str(e)
+    
+    # в пуле процессов у каждого свой граф форм; замок нужен, только
+    # когда пула нет и проверка идёт в потоках датасетов
+    with dcatapShapesLock:
+        conforms, _, text = pyshacl.validate(data, shacl_graph = shapes, inference = "none")
+    return conforms, text
+
+def validateDCATAPRemote(filePath, mediaType):
+    headers = { "Content-Type": mediaType }
+    try:
+        with open(filePath, "rb") as data:
+            response = httpPost(dcatapServiceUrl, headers = headers, data = data)
+    except requests.exceptions.RequestException as e:
+        return None, str(e)
+    if response.status_code == 200:
+        return True, response.text
+    if response.status_code == 400:
+        return False, response.text
+    return None, response.text
+
+def getValidatorVersion(validator):
+    # меняется вместе с формами или сервисом - старые вердикты не подходят
+    global dcatapLocalVersion
+    if validator == "remote":
+        return "remote " + dcatapServiceUrl
+    
+    with dcatapShapesLock:
+        if dcatapLocalVersion is None:
+            import pyshacl
+            dcatapLocalVersion = "local " + pyshacl.__version__ + " " + hashFile(dcatapShapesFile)
+    return dcatapLocalVersion
+
+def countDCATAPCache(key):
+    with dcatapCacheLock:
+        dcatapCacheStats[key] += 1
+
+def getVerdictPath(payloadHash, mediaType, version):
+    key = hashlib.sha256((payloadHash + "\n" + mediaType.strip().lower() + "\n" + version).encode("utf-8")).hexdigest()
+    return os.path.join(cacheDir, "dcatap", key + ".json")
+
+def pruneVerdictCache(directory):
+    # раз за прогон убираем просроченные вердикты, в том числе от старых форм
+    global dcatapCachePruned
+    with dcatapCacheLock:
+        if dcatapCachePruned:
+            return
+        dcatapCachePruned = True
+        now = time.time()
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            try:
+                if now - os.path.getmtime(path) > dcatapCacheMaxAge:
+                    os.remove(path)
+                    dcatapCacheStats["expired"] += 1
+            except OSError:
+                pass
+
+def loadVerdict(verdictPath):
+    try:
+        if time.time() - os.path.getmtime(verdictPath) > dcatapCacheMaxAge:
+            return None
+        with open(verdictPath, "r", encoding="utf-8") as file:
+            verdict = json.load(file)
+    except (OSError, ValueError):
         return None
+    return verdict["conforms"], verdict["report"]
+
+def storeVerdict(verdictPath, conforms, report):
+    directory = os.path.dirname(verdictPath)
+    os.makedirs(directory, exist_ok = True)
+    pruneVerdictCache(directory)
+    verdict = {"conforms": conforms, "report": report, "checked_at": time.time()}
+    try:
+        writeFileAtomic(verdictPath, json.dumps(verdict, ensure_ascii = False).encode("utf-8"))
+        countDCATAPCache("stored")
+    except OSError as e:
+        log.warning("не удалось сохранить вердикт в кэш: %s", e)
+
+def reportLocalUnavailable(e):
+    # локальная проверка недоступна: без dcatapRemoteFallback вердикта нет,
+    # с ним - проверка через сервис; сообщается один раз за прогон
+    global dcatapFallbackReported
+    with dcatapCacheLock:
+        reported = dcatapFallbackReported
+        dcatapFallbackReported = True
+    if reported:
+        return
+    if isinstance(e, ImportError):
+        reason = "нет rdflib/pyshacl (" + str(e) + ")"
     else:
-        data = dataReq.text
-        size = "[" + getReadableSize(sys.getsizeof(data)) + "]"
-        print(" @ файл скачен:", link[0], size) # ////
+        reason = "нет форм " + dcatapShapesFile + " (" + str(e) + ")"
+    if dcatapRemoteFallback:
+        log.warning("локальная проверка DCAT-AP недоступна: %s, проверка через сервис %s", reason, dcatapServiceUrl)
+    else:
+        log.error("локальная проверка DCAT-AP недоступна: %s; установите rdflib и pyshacl, "
+                  "или --dcatap remote, или --dcatap-fallback", reason)
+
+def checkDCATAPValidator():
+    # без rdflib/pyshacl или форм каждый датасет получил бы DCAT-AP False
+    # и неполную запись - без проверки через сервис прогон не начинается
+    if dcatapValidator != "local":
+        return True
+    try:
+        import rdflib
+        getValidatorVersion("local")
+    except (ImportError, OSError) as e:
+        reportLocalUnavailable(e)
+        return dcatapRemoteFallback
+    return True
+
+def cachedValidateDCATAP(filePath, mediaType):
+    # вердикт по хэшу содержимого, типу и версии проверки:
+    # неизменившийся файл повторно не проверяется и не отправляется
+    validators = [dcatapValidator]
+    if dcatapValidator == "local" and dcatapRemoteFallback:
+        validators.append("remote")
+    payloadHash = hashFile(filePath) if useDCATAPCache else None
+    
+    for validator in validators:
+        verdictPath = None
+        if useDCATAPCache:
+            try:
+                version = getValidatorVersion(validator)
+            except (ImportError, OSError) as e:
+                reportLocalUnavailable(e)
+                continue
+            verdictPath = getVerdictPath(payloadHash, mediaType, version)
+            verdict = loadVerdict(verdictPath)
+            if verdict is not None:
+                countDCATAPCache("hits")
+                return verdict
+            countDCATAPCache("misses")
         
-        if not os.path.exists("temp"):
-            os.mkdir("temp")
-        with open(filePath, "w", encoding="utf-8") as file:
-            file.write(data)
+        if validator == "local":
+            try:
+                conforms, report = runCpu(validateDCATAPLocal, filePath, mediaType)
+            except (ImportError, OSError) as e:
+                reportLocalUnavailable(e)
+                continue
+        else:
+            conforms, report = validateDCATAPRemote(filePath, mediaType)
         
-        return data
+        # ошибки сервиса не кэшируются
+        if conforms is not None and verdictPath is not None:
+            storeVerdict(verdictPath, conforms, report)
+        return conforms, report
+    
+    return None, "проверка недоступна"
+
+def compareDCATAPValidators(directory):
+    # файлы-образцы с ожидаемым вердиктом (expected.json): локальная проверка
+    # должна совпадать с ожиданием, а если сервис доступен - и с сервисом
+    with open(os.path.join(directory, "expected.json"), "r", encoding="utf-8") as file:
+        expected = json.load(file)
+    
+    mismatches = 0
+    for name, fixture in sorted(expected.items()):
+        filePath = os.path.join(directory, name)
+        try:
+            local, _ = validateDCATAPLocal(filePath, fixture["mediaType"])
+        except (ImportError, OSError) as e:
+            local = None
+            reportLocalUnavailable(e)
+        remote, report = validateDCATAPRemote(filePath, fixture["mediaType"])
+        if remote is None:
+            log.debug("сервис: %s", report)
+        
+        verdicts = [v for v in [local, remote] if v is not None]
+        ok = bool(verdicts) and all(v == fixture["conforms"] for v in verdicts)
+        if not ok:
+            mismatches += 1
+        print("%-36s ожидается %-5s локально %-5s сервис %-5s %s" % (
+            name, fixture["conforms"], local, remote, "ok" if ok else "РАСХОЖДЕНИЕ"))
+    return mismatches
 
 def checkComplianceDCATAP(mediaDownloadURL, id):
-    print(" @ ---DCAT-AP---") # ////
+    log.debug("---DCAT-AP---")
     r = checkComplianceDCATAP_p(mediaDownloadURL, id)
-    print(" @ ---DCAT-AP---") # ////
+    log.debug("---DCAT-AP---")
     return r
 
 def checkComplianceDCATAP_p(mediaDownloadURL, id):
     if not mediaDownloadURL:
-        print(" @ нет медиа-типа или ссылки скачивания") # ////
+        log.info("нет медиа-типа или ссылки скачивания")
         return False
     
     for md in mediaDownloadURL:
         url = md[1]
         
-        data = downloadData(md, id)
+        filePath = downloadData(md, id)
+        if filePath is None:
+            return False
         
-        if data:
-            size = "[" + getReadableSize(sys.getsizeof(data)) + "]"
-            headers = { "Content-Type": md[0] }
-            
-            serviseUrl = "https://data.europa.eu/api/mqa/shacl/validation/report"
-            try:
-                response = requests.post(serviseUrl, headers = headers, data = data)
-                if response.status_code == 200:
-                    print(" @ проверка успешна, файл:     ", md[0], size) # ////
-                elif response.status_code == 400:
-                    print(" @ проверка провалилась, файл: ", md[0], size) # ////
-                    print(" @  : ", response.text)
-                    return False
-                else:
-                    print(" @ произошла ошибка1, файл:    ", md[0], size) # ////
-                    print(" @  : ", response.text)
-                    return False
-            except requests.exceptions.RequestException as e:
-                print(" @ произошла ошибка2, файл:        ", md[0], size) # ////
+        try:
+            fileSize = os.path.getsize(filePath)
+            if fileSize == 0:
                 return False
+            conforms, report = cachedValidateDCATAP(filePath, md[0])
+        finally:
+            releaseDownload(filePath)
+        size = "[" + getReadableSize(fileSize) + "]"
+        
+        if conforms is True:
+            log.info("проверка успешна, файл:      %s %s", md[0], size)
+        elif conforms is False:
+            log.info("проверка провалилась, файл:  %s %s", md[0], size)
+            log.debug(" : %s", report)
+            return False
         else:
+            log.warning("произошла ошибка, файл:      %s %s", md[0], size)
+            countFailure("dcatap_error")
+            log.debug(" : %s", report)
             return False
     return True
 
@@ -313,40 +2005,33 @@ def checkComplianceDCATAP_p(mediaDownloadURL, id):
 
 
 
-def findLicense(soup):
+def findLicense(page):
     licenses = []
 
-    l = findDataInTable(soup, "License")
+    l = findDataInTable(page, "License")
     if l is not None:
         licenses.append(l)
-    print(" @ License:     " + str(l)) # ////
+    log.debug("License:     %s", l)
 
-    l = findDataInTable(soup, "License Url")
+    l = findDataInTable(page, "License Url")
     if l is not None:
         licenses.append(l)
-    print(" @ License Url: " + str(l)) # ////
+    log.debug("License Url: %s", l)
 
-    l = findDataInTable(soup, "Licence")
+    l = findDataInTable(page, "Licence")
     if l is not None:
         licenses.append(l)
-    print(" @ Licence:     " + str(l)) # ////
+    log.debug("Licence:     %s", l)
     
-    l = findDataInTable(soup, "Licence Url")
+    l = findDataInTable(page, "Licence Url")
     if l is not None:
         licenses.append(l)
-    print(" @ Licence Url: " + str(l)) # ////
+    log.debug("Licence Url: %s", l)
     
-    l = None
-    licenseTag = soup.find("strong", string="License:")
-    if licenseTag is not None:
-        licenseSpan = licenseTag.parent
-        l = licenseSpan.text.strip()
-        if l.startswith("License:"):
-            l = l[8:]
-            l = l.strip()
-        
+    l = page["licenseTag"]
+    if l is not None:
         licenses.append(l)
-    print(" @ License Tag: " + str(l)) # ////
+    log.debug("License Tag: %s", l)
     
     licenses = [
         s for s in licenses if "No license information was provided" not in s
@@ -365,14 +2050,14 @@ def isVocabularyLicense(licenses, licencesVocabulary):
         return False
     
     for l in licenses:
-        if l in licencesVocabulary:
+        if normalizeLicense(l) in licencesVocabulary:
             return True
     return False
 
 
 
-def findAccessRestrictions(soup):
-    return findDataInTable(soup, "Public Access Level")
+def findAccessRestrictions(page):
+    return findDataInTable(page, "Public Access Level")
 
 def haveAccessRestrictions(access):
     return access is not None
@@ -396,13 +2081,12 @@ def isNoreply(email):
     else:
         return True
 
-def haveContact(soup):
-    contactTag = soup.find("a", title="contact")
-    if contactTag is None:
-        print(" @ нет тега контакта") # ////
+def haveContact(page):
+    email = page["contact"]
+    if email is None:
+        log.debug("нет тега контакта")
         return False
-    email = contactTag["href"]
-    print(" @ mail: " + email) # ////
+    log.debug("mail: %s", email)
     if isNoreply(email):
         return False
     else:
@@ -410,12 +2094,12 @@ def haveContact(soup):
 
 
 
-def havePublisher(soup):
-    publsherTag = soup.find("a", title="publsher")
-    if publsherTag is None:
-        print(" @ нет тега издателя") # ////
+def havePublisher(page):
+    publisher = page["publisher"]
+    if publisher is None:
+        log.debug("нет тега издателя")
         return False
-    print(" @ publisher: " + publsherTag.text) # ////
+    log.debug("publisher: %s", publisher)
     return True
 
 
@@ -424,104 +2108,278 @@ def havePublisher(soup):
 
 
 
-def findDownloadLinks(soup):
-    links = []
-    
-    downloadSection = soup.find("section", id = "dataset-resources")
-    if downloadSection is not None:
-        buttons = downloadSection.find_all("i", class_ = "fa fa-download")
-        for b in buttons:
-            l = b.parent
-            links.append((l["data-format"], l["href"]))
-            
-    return links
+def findDownloadLinks(page):
+    return list(page["downloadLinks"])
 
-def downloadDataFile(link, id):
-    url = link[1]
-    
-    response = requests.head(url)
-    content_type = response.headers.get("content-type")
-    if content_type and content_type.startswith("text/html"):
-        print(" @ по ссылке на скачивание нет файла:", link[0]) # ////
-        return None
-    
-    filePath = os.path.join("temp", id + "_" + link[0])
-    
-    if os.path.isfile(filePath):
-        print(" @ файл найден на диске:", link[0]) # ////
-        return filePath
-    
-    dataReq = requests.get(url)
-        
-    if dataReq.status_code != 200:
-        print(" @ не удалось скачать файл:", link[0]) # ////
-        return None
-    else:
-        data = dataReq.text
-        size = "[" + getReadableSize(sys.getsizeof(data)) + "]"
-        print(" @ файл скачен:", link[0], size) # ////
-        
-        if not os.path.exists("temp"):
-            os.mkdir("temp")
-        with open(filePath, "w", encoding="utf-8") as file:
-            file.write(data)
-        
-        return filePath
+def downloadDataFile(link, id, probe = None):
+    return fetchDataFile(link, probe)
 
-def checkFiles(downloadLinks, id):
-    print(" @ ---Files---") # ////
-    r = checkFiles_d(downloadLinks, id)
-    print(" @ ---Files---") # ////
+def checkFiles(downloadLinks, id, timings = None, probes = None):
+    log.debug("---Files---")
+    r = checkFiles_d(downloadLinks, id, {} if timings is None else timings, probes)
+    log.debug("---Files---")
     return r
     
-def checkFiles_d(downloadLinks, id):
+def isHeadSampling():
+    return profilingMode == "sample" and sampleMethod == "head"
+
+def profileHead(link, probe, timings):
+    # выборка из первых строк: скачиваются только они, число строк
+    # во всём файле оценивается по его размеру
+    with timeStage(timings, "download"):
+        head = fetchDataHead(link, sampleRows + 1)
+    if head is None:
+        return None
+    filePath, size = head
+    try:
+        with timeStage(timings, "profile"):
+            res = runCpu(profileCsv, filePath, probe.get("delimiter", ","), size)
+    finally:
+        os.remove(filePath)
+    if res is None:
+        log.info("начало файла не прочиталось, файл скачивается целиком: %s", link[0])
+    return res
+
+def checkFiles_d(downloadLinks, id, timings, probes = None):
     if not downloadLinks:
-        print(" @ нет файлов для скачивания") # ////
+        log.info("нет файлов для скачивания")
         return None
     
-    data = None
+    profilers = {
+        "CSV":     profileCsv,
+        "TSV":     profileCsv,
+        "JSON":    profileJson,
+        "GEOJSON": profileJson,
+        "XLSX":    profileXlsx,
+    }
+    
+    # профилировщик выбирается по формату содержимого, если ссылка уже
+    # проверена, иначе по подписи каталога до проверки
+    if probes is None:
+        probes = {}
+    links = []
     for dl in downloadLinks:
-        if dl[0] == "csv":
-            file = downloadDataFile(dl, id)
-            if file is not None:
-                data = pd.read_csv(file)
-                if not isinstance(data, pd.DataFrame) or data.empty:
-                    print(" @ не удалось прочитать файл: ", dl[0]) # ////
-                    data = None
-                else:
-                    break
+        probe = probes.get(dl[1])
+        format = getProbeFormat(dl, probe)
+        if format in profilers:
+            links.append((dl, probe, format))
+    
+    # сначала CSV, потом остальные табличные форматы
+    links.sort(key = lambda l: list(profilers).index(l[2]))
+    
+    res = None
+    for dl, probe, format in links:
+        with pendingFileSlot():
+            if probe is None:
+                with timeStage(timings, "download"):
+                    probe = probeDataFile(dl)
+                if probe is None:
+                    continue
+            format = getProbeFormat(dl, probe)
+            if format not in profilers:
+                log.info("формат %s по содержимому: %s, пропуск", dl[0], probe["format"])
+                continue
+            
+            res = None
+            if format in ("CSV", "TSV") and isHeadSampling():
+                res = profileHead(dl, probe, timings)
+            if res is None:
+                with timeStage(timings, "download"):
+                    file = downloadDataFile(dl, id, probe)
+                if file is None:
+                    continue
+                try:
+                    with timeStage(timings, "profile"):
+                        if format in ("CSV", "TSV"):
+                            res = runCpu(profileCsv, file, probe.get("delimiter", ","))
+                        else:
+                            res = runCpu(profilers[format], file)
+                finally:
+                    releaseDownload(file)
+        if res is None:
+            log.warning("не удалось прочитать файл: %s", dl[0])
+            countFailure("profile_" + format.lower())
+        else:
+            break
                         
-    if data is None:
-        print(" @ не удалось найти подходящего формата") # ////
+    if res is None:
+        log.info("не удалось найти подходящего формата")
         return None
     
-    num_rows = data.shape[0]
-    num_columns = data.shape[1]
-    
-    unique_values = list(data.nunique().items())
-    missing_values = list(data.isnull().sum().items())
-    
-    unique_values = [x[1] for x in unique_values]
-    missing_values = [x[1] for x in missing_values]
-    
-    
-    dataName = list(data)
-    dataNumbersName = list(data.select_dtypes(include=["float64", "int64"]))
-    
-    column_names = dataName
+    return res
+
+def newProfile():
+    return {"num_rows": 0, "columns": OrderedDict()}
+
+def newColumnProfile():
+    c = {
+        "unique":  set(),
+        "missing": 0,
+        "numeric": True,
+        "float":   False,
+        "zero":    0,
+        "min":     None,
+        "max":     None,
+        "sum":     0.0,
+        "count":   0,
+    }
+    if profilingMode == "approximate":
+        # вместо множества значений - регистры HyperLogLog и выборка для квантилей
+        c["unique"] = np.zeros(2**hllPrecision, dtype = np.uint8)
+        c["sample"] = np.empty(0, dtype = np.float64)
+        c["sampleKeys"] = np.empty(0, dtype = np.float64)
+    return c
+
+def hllUpdate(registers, hashes):
+    # первые hllPrecision бит хэша - номер регистра,
+    # в регистре - максимум позиции первой единицы в следующих 32 битах
+    index = (hashes >> np.uint64(64 - hllPrecision)).astype(np.int64)
+    bits = (hashes >> np.uint64(64 - hllPrecision - 32)) & np.uint64(0xFFFFFFFF)
+    mantissa, exponent = np.frexp(bits.astype(np.float64))
+    rank = (33 - exponent).astype(np.uint8)
+    np.maximum.at(registers, index, rank)
+
+def hllCount(registers):
+    # стандартная ошибка 1.04 / sqrt(2**hllPrecision): при 14 битах ~0.8%,
+    # т.е. в пределах ±2% с вероятностью ~98%
+    m = registers.shape[0]
+    alpha = 0.7213 / (1 + 1.079 / m)
+    estimate = alpha * m * m / np.sum(np.ldexp(1.0, -registers.astype(np.int64)))
+    zeros = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * m and zeros > 0:
+        estimate = m * np.log(m / zeros)
+    return int(round(estimate))
+
+def sampleUpdate(c, values):
+    # равномерная выборка без возвращения: каждому значению случайный ключ,
+    # храним quantileSampleSize значений с наименьшими ключами
+    keys = np.random.random(values.shape[0])
+    sample = np.concatenate([c["sample"], values])
+    sampleKeys = np.concatenate([c["sampleKeys"], keys])
+    if sample.shape[0] > quantileSampleSize:
+        keep = np.argpartition(sampleKeys, quantileSampleSize)[:quantileSampleSize]
+        sample = sample[keep]
+        sampleKeys = sampleKeys[keep]
+    c["sample"] = sample
+    c["sampleKeys"] = sampleKeys
+
+def isNumericColumn(col):
+    # числовой ли столбец, решает схема чтения: nullable Int, float32 и т.п. тоже числа
+    return pd.api.types.is_numeric_dtype(col.dtype) and not pd.api.types.is_bool_dtype(col.dtype)
+
+def updateProfile(profile, chunk):
+    # все статистики обновляются за один проход по куску,
+    # сам кусок после этого больше не нужен
+    rowsBefore = profile["num_rows"]
+    profile["num_rows"] += chunk.shape[0]
+    
+    # в JSON у записей может не быть части полей: их нет и в куске
+    for name, c in profile["columns"].items():
+        if name not in chunk.columns:
+            c["missing"] += chunk.shape[0]
+    
+    for name in chunk.columns:
+        col = chunk[name]
+        c = profile["columns"].get(name)
+        if c is None:
+            c = newColumnProfile()
+            c["missing"] = rowsBefore
+            profile["columns"][name] = c
+        
+        values = col.dropna()
+        c["missing"] += col.shape[0] - values.shape[0]
+        
+        approximate = "sample" in c
+        
+        if c["numeric"] and not isNumericColumn(col) and values.shape[0] > 0:
+            # столбец оказался не числовым: как и при чтении целиком,
+            # все значения считаются строками
+            c["numeric"] = False
+            if approximate:
+                c["sample"] = c["sampleKeys"] = np.empty(0, dtype = np.float64)
+            else:
+                c["unique"] = {stringifyValue(v) for v in c["unique"]}
+        
+        if c["numeric"]:
+            if pd.api.types.is_float_dtype(col.dtype):
+                c["float"] = True
+            if approximate:
+                numbers = values.astype("float64")
+                hllUpdate(c["unique"], pd.util.hash_pandas_object(numbers, index = False).to_numpy())
+                sampleUpdate(c, numbers.to_numpy())
+            else:
+                c["unique"].update(values.unique().tolist())
+            if values.shape[0] > 0:
+                c["zero"] += int((values == 0).sum())
+                low = values.min()
+                high = values.max()
+                c["min"] = low if c["min"] is None else min(c["min"], low)
+                c["max"] = high if c["max"] is None else max(c["max"], high)
+                c["sum"] += float(values.sum())
+                c["count"] += values.shape[0]
+        elif approximate:
+            hllUpdate(c["unique"], pd.util.hash_pandas_object(values.astype(str), index = False).to_numpy())
+        elif isTextColumn(col):
+            c["unique"].update(values.unique().tolist())
+        else:
+            c["unique"].update(stringifyValue(v) for v in values.unique().tolist())
+
+def isTextColumn(col):
+    dtype = col.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        dtype = dtype.categories.dtype
+    return pd.api.types.is_string_dtype(dtype) and not pd.api.types.is_object_dtype(dtype)
+
+def stringifyValue(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def finishProfile(profile):
+    column_names = list(profile["columns"])
+    unique_values = []
+    missing_values = []
     amount_zero = []
     min_values = []
     max_values = []
     mean_values = []
+    median_values = []
+    p95_values = []
+    approximate = profilingMode == "approximate"
     
-    for i in range(data.shape[1]):
-        if dataName[i] in dataNumbersName:
-            col = data[dataName[i]]
-            
-            amount_zero.append(col[col == 0].count())
-            min_values.append(col.min())
-            max_values.append(col.max())
-            mean_values.append(round(col.mean(), 2))
+    for c in profile["columns"].values():
+        if approximate:
+            unique_values.append(hllCount(c["unique"]))
+        else:
+            unique_values.append(len(c["unique"]))
+        missing_values.append(c["missing"])
+        
+        if approximate:
+            if c["numeric"] and c["sample"].shape[0] > 0:
+                median, p95 = np.quantile(c["sample"], [0.5, 0.95])
+                median_values.append(round(float(median), 2))
+                p95_values.append(round(float(p95), 2))
+            elif c["numeric"]:
+                median_values.append(float("nan"))
+                p95_values.append(float("nan"))
+            else:
+                median_values.append("-")
+                p95_values.append("-")
+        
+        if c["numeric"]:
+            if c["count"] == 0:
+                low = high = mean = float("nan")
+            else:
+                low = c["min"].item() if hasattr(c["min"], "item") else c["min"]
+                high = c["max"].item() if hasattr(c["max"], "item") else c["max"]
+                if c["float"]:
+                    low = float(low)
+                    high = float(high)
+                mean = round(c["sum"] / c["count"], 2)
+            amount_zero.append(c["zero"])
+            min_values.append(low)
+            max_values.append(high)
+            mean_values.append(mean)
         else:
             amount_zero.append("-")
             min_values.append("-")
@@ -529,8 +2387,8 @@ def checkFiles_d(downloadLinks, id):
             mean_values.append("-")
 
     res = {
-        "num_rows":       num_rows,
-        "num_columns":    num_columns,
+        "num_rows":       profile["num_rows"],
+        "num_columns":    len(column_names),
         "column_names":   column_names,
         "unique_values":  unique_values,
         "missing_values": missing_values,
@@ -541,8 +2399,338 @@ def checkFiles_d(downloadLinks, id):
         "mean_values":    mean_values,
     }
     
+    if approximate:
+        res["approximate"] = True
+        res["median_values"] = median_values
+        res["p95_values"] = p95_values
+    
     return res
 
+def inferCsvSchema(file, delimiter = ","):
+    # схема по первым schemaScanRows строкам: строковые столбцы с небольшим
+    # числом значений читаются как category; числовые парсер читает сам
+    # (явный Int64 парсится из строк в разы медленнее), а сужаются они
+    # уже после чтения в downcastChunk
+    prefix = pd.read_csv(file, nrows = schemaScanRows, sep = delimiter)
+    dtypes = {}
+    for name in prefix.columns:
+        col = prefix[name]
+        if pd.api.types.is_object_dtype(col.dtype) or pd.api.types.is_string_dtype(col.dtype):
+            unique = col.nunique()
+            if unique <= categoryMaxUnique and unique <= col.shape[0] // 2:
+                dtypes[name] = "category"
+    return dtypes
+
+def downcastChunk(chunk):
+    # сужение по фактическим значениям куска: при чтении сразу в int8/int16
+    # pandas молча переполняет значения, поэтому сужаем после чтения;
+    # целые с пропусками становятся nullable Int вместо float64
+    for name in chunk.columns:
+        col = chunk[name]
+        if pd.api.types.is_bool_dtype(col.dtype):
+            continue
+        if pd.api.types.is_integer_dtype(col.dtype):
+            chunk[name] = pd.to_numeric(col, downcast = "integer")
+        elif col.dtype == "float64":
+            values = col.to_numpy()
+            known = values[~np.isnan(values)]
+            if known.shape[0] == 0:
+                continue
+            if np.all(known == np.round(known)) and np.abs(known).max() < 2**53:
+                chunk[name] = pd.to_numeric(col.astype("Int64"), downcast = "integer")
+            elif np.all(known.astype(np.float32) == known):
+                chunk[name] = col.astype("float32")
+    return chunk
+
+def readCsvChunks(file, dtypes = None, engine = None, delimiter = ","):
+    if (engine or csvEngine) == "pyarrow":
+        try:
+            import pyarrow.csv as pacsv
+        except ImportError:
+            pacsv = None
+        if pacsv is not None:
+            # pyarrow сам выводит типы и кодирует строки словарём (-> category)
+            reader = pacsv.open_csv(
+                file,
+                parse_options = pacsv.ParseOptions(delimiter = delimiter),
+                convert_options = pacsv.ConvertOptions(
+                    strings_can_be_null = True,
+                    auto_dict_encode = True,
+                    auto_dict_max_cardinality = categoryMaxUnique,
+                ),
+            )
+            for batch in reader:
+                yield batch.to_pandas()
+            return
+        log.warning("pyarrow не установлен, используется движок c")
+    
+    # для выборки из начала больше sampleRows строк не нужно
+    chunkRows = min(profileChunkRows, sampleRows) if isHeadSampling() else profileChunkRows
+    for chunk in pd.read_csv(file, chunksize = chunkRows, dtype = dtypes, sep = delimiter):
+        if dtypes:
+            chunk = downcastChunk(chunk)
+        yield chunk
+
+def estimateCsvRows(file, rows, totalBytes = None):
+    # средняя длина строки по первым rows строкам -> число строк во всём файле
+    # (totalBytes - размер всего файла, если скачано только начало)
+    with open(file, "rb") as f:
+        header = f.readline()
+        sampleBytes = 0
+        counted = 0
+        for line in f:
+            sampleBytes += len(line)
+            counted += 1
+            if counted >= rows:
+                break
+    if sampleBytes == 0:
+        return counted
+    if totalBytes is None:
+        totalBytes = os.path.getsize(file)
+    return int(round((totalBytes - len(header)) / (sampleBytes / counted)))
+
+def sampleChunks(chunks, profile):
+    # строки выборки попадают в profile; возвращается число строк в файле
+    # или None, если файл прочитан не до конца и число нужно оценить
+    if sampleMethod == "reservoir":
+        # равномерная выборка по всему файлу: каждой строке случайный ключ,
+        # храним sampleRows строк с наименьшими ключами
+        sample = None
+        sampleKeys = None
+        total = 0
+        for chunk in chunks:
+            total += chunk.shape[0]
+            keys = np.random.random(chunk.shape[0])
+            if chunk.shape[0] > sampleRows:
+                keep = np.argpartition(keys, sampleRows)[:sampleRows]
+                chunk = chunk.iloc[keep]
+                keys = keys[keep]
+            if sample is None:
+                sample, sampleKeys = chunk, keys
+            else:
+                sample = pd.concat([sample, chunk], ignore_index = True)
+                sampleKeys = np.concatenate([sampleKeys, keys])
+            if sample.shape[0] > sampleRows:
+                keep = np.argpartition(sampleKeys, sampleRows)[:sampleRows]
+                sample = sample.iloc[keep].reset_index(drop = True)
+                sampleKeys = sampleKeys[keep]
+        if sample is not None:
+            updateProfile(profile, sample)
+        return total
+    
+    parts = []
+    rows = 0
+    for chunk in chunks:
+        parts.append(chunk.iloc[:sampleRows - rows])
+        rows += parts[-1].shape[0]
+        if rows >= sampleRows:
+            break
+    if not parts:
+        return 0
+    sample = pd.concat(parts, ignore_index = True)
+    updateProfile(profile, sample)
+    if sample.shape[0] < sampleRows:
+        return sample.shape[0]
+    return None
+
+def readProfile(chunks, profile, estimateRows):
+    # профиль по кускам любого формата; для выборки возвращает
+    # (оценку) числа строк в файле, иначе None
+    if profilingMode == "sample":
+        total = sampleChunks(chunks, profile)
+        if total is None:
+            total = estimateRows()
+        return total
+    for chunk in chunks:
+        updateProfile(profile, chunk)
+    return None
+
+def finishFileInfo(profile, estimatedRows):
+    if profile["num_rows"] == 0 or not profile["columns"]:
+        return None
+    
+    res = finishProfile(profile)
+    if estimatedRows is not None:
+        res["sampled"] = True
+        res["sample_size"] = profile["num_rows"]
+        res["estimated_rows"] = estimatedRows
+    return res
+
+def profileCsv(file, delimiter = ",", totalBytes = None):
+    # файл читается кусками по profileChunkRows строк,
+    # память ограничена размером куска и множествами уникальных значений
+    dtypes = None
+    if useTypedCsv and csvEngine != "pyarrow":
+        try:
+            dtypes = inferCsvSchema(file, delimiter)
+        except (ValueError, UnicodeDecodeError) as e:
+            log.warning("ошибка чтения: %s", e)
+            return None
+    
+    estimateRows = lambda: estimateCsvRows(file, sampleRows, totalBytes)
+    
+    profile = newProfile()
+    try:
+        estimatedRows = readProfile(readCsvChunks(file, dtypes, csvEngine, delimiter), profile, estimateRows)
+    except (ValueError, UnicodeDecodeError) as e:
+        if not dtypes and csvEngine != "pyarrow":
+            log.warning("ошибка чтения: %s", e)
+            return None
+        # дальше по файлу значения не подошли к выведенной схеме
+        log.info("файл читается заново без схемы: %s", e)
+        profile = newProfile()
+        try:
+            estimatedRows = readProfile(readCsvChunks(file, None, "c", delimiter), profile, estimateRows)
+        except (ValueError, UnicodeDecodeError) as e:
+            log.warning("ошибка чтения: %s", e)
+            return None
+    
+    return finishFileInfo(profile, estimatedRows)
+
+def batchRows(rows, columns = None):
+    # строки (списки или словари) -> куски DataFrame по profileChunkRows строк
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= profileChunkRows:
+            yield pd.DataFrame(batch, columns = columns)
+            batch = []
+    if batch:
+        yield pd.DataFrame(batch, columns = columns)
+
+def flattenValue(value):
+    # вложенные объекты и массивы считаются одним строковым значением
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii = False, sort_keys = True)
+    return value
+
+def findJsonRows(file, ijson):
+    # где в документе лежат строки таблицы:
+    # массив объектов, GeoJSON FeatureCollection или rows.json Socrata
+    columns = []
+    metaSeen = False
+    dataSeen = False
+    with open(file, "rb") as f:
+        for prefix, event, value in ijson.parse(f):
+            if prefix == "" and event == "start_array":
+                return "item", None
+            if prefix == "meta.view.columns.item.name" and event == "string":
+                columns.append(value)
+            if prefix == "meta" and event == "end_map":
+                metaSeen = True
+                if dataSeen:
+                    break
+            if prefix == "" and event == "map_key":
+                if value == "features":
+                    return "features.item", None
+                if value == "data":
+                    if metaSeen:
+                        return "data.item", columns or None
+                    # meta может идти после data: имена столбцов ищем дальше,
+                    # строки прочитаются вторым проходом
+                    dataSeen = True
+    if dataSeen:
+        return "data.item", columns or None
+    return None, None
+
+def readJsonChunks(file, ijson, position):
+    itemsPrefix, columns = findJsonRows(file, ijson)
+    if itemsPrefix is None:
+        return
+    
+    with open(file, "rb") as f:
+        items = ijson.items(f, itemsPrefix, use_float = True)
+        if itemsPrefix == "features.item":
+            rows = (
+                dict(
+                    {k: flattenValue(v) for k, v in (item.get("properties") or {}).items()},
+                    geometry_type = (item.get("geometry") or {}).get("type")
+                )
+                for item in items
+            )
+        elif itemsPrefix == "data.item" and columns:
+            rows = ([flattenValue(v) for v in item[:len(columns)]] for item in items)
+        else:
+            rows = (
+                {k: flattenValue(v) for k, v in item.items()} if isinstance(item, dict) else {"value": flattenValue(item)}
+                for item in items
+            )
+        for chunk in batchRows(rows, columns):
+            position[0] = f.tell()
+            position[1] += chunk.shape[0]
+            yield chunk
+
+def profileJson(file):
+    # JSON и GeoJSON разбираются потоково через ijson, документ целиком
+    # в память не загружается
+    try:
+        import ijson
+    except ImportError:
+        log.warning("ijson не установлен, JSON не профилируется")
+        return None
+    
+    # сколько байт файла и записей прочитано
+    position = [0, 0]
+    def estimateRows():
+        if position[0] == 0:
+            return position[1]
+        return int(round(position[1] * os.path.getsize(file) / position[0]))
+    
+    profile = newProfile()
+    try:
+        estimatedRows = readProfile(readJsonChunks(file, ijson, position), profile, estimateRows)
+    except (ValueError, ijson.JSONError) as e:
+        log.warning("ошибка чтения: %s", e)
+        return None
+    
+    return finishFileInfo(profile, estimatedRows)
+
+def readXlsxChunks(ws):
+    rows = ws.iter_rows(values_only = True)
+    
+    header = None
+    for row in rows:
+        if any(v is not None for v in row):
+            header = row
+            break
+    if header is None:
+        return
+    
+    # имена столбцов как у pandas: пустые - Unnamed: i, повторы - имя.1
+    columns = []
+    for i, name in enumerate(header):
+        name = "Unnamed: " + str(i) if name is None else str(name)
+        unique = name
+        n = 0
+        while unique in columns:
+            n += 1
+            unique = name + "." + str(n)
+        columns.append(unique)
+    
+    rows = (row[:len(columns)] for row in rows if any(v is not None for v in row))
+    yield from batchRows(rows, columns)
+
+def profileXlsx(file):
+    # первый лист читается построчно в режиме read_only
+    try:
+        wb = openpyxl.load_workbook(file, read_only = True, data_only = True)
+    except Exception as e:
+        log.warning("ошибка чтения: %s", e)
+        return None
+    
+    try:
+        ws = wb.worksheets[0]
+        estimateRows = lambda: (ws.max_row - 1) if ws.max_row else sampleRows
+        profile = newProfile()
+        estimatedRows = readProfile(readXlsxChunks(ws), profile, estimateRows)
+    except (ValueError, KeyError) as e:
+        log.warning("ошибка чтения: %s", e)
+        return None
+    finally:
+        wb.close()
+    
+    return finishFileInfo(profile, estimatedRows)
+
 def printInfo(r):
     if r is None:
         print("нет табличных данных")
@@ -558,16 +2746,27 @@ def printInfo(r):
         
         print("количество строк:   ", r["num_rows"])
         print("количество столбцов:", num_columns)
+        if r.get("sampled"):
+            print("выборка:             " + str(r["sample_size"]) + " строк из ~" + str(r["estimated_rows"]))
+        if r.get("approximate"):
+            print("приближённые уникальные и квантили")
         
         print("---")
         
         randeValues = ["№"] + list(range(1, num_columns+1))
         
-        data = zip_longest(randeValues, unique_values, missing_values, amount_zero,
-                           min_values, max_values, mean_values, fillvalue='')
+        columns = [randeValues, unique_values, missing_values, amount_zero,
+                   min_values, max_values, mean_values]
+        rowFormat = "{:<5} {:<12} {:<12} {:<12} {:<15} {:<15} {:<15}"
+        if "median_values" in r:
+            columns.append(["Медиана"] + r["median_values"])
+            columns.append(["p95"] + r["p95_values"])
+            rowFormat += " {:<15} {:<15}"
+        
+        data = zip_longest(*columns, fillvalue='')
 
         for values in data:
-            print("{:<5} {:<12} {:<12} {:<12} {:<15} {:<15} {:<15}".format(*values))
+            print(rowFormat.format(*values))
 
 
 
@@ -616,111 +2815,318 @@ def printConsole(Interoperability_Info, Reusability_Info, File_Info):
 
 
 
+reportLabels = [
+    "Format",
+    "Media_type",
+    "Format_Media_type_from_vocabulary",
+    "Non_proprietary",
+    "Machine_readable",
+    "DCATAP_compliance",
+    "License_information",
+    "License_vocabulary",
+    "Access_restrictions",
+    "Access_restrictions_vocabulary",
+    "Contact_point",
+    "Publisher",
+    "Rating",
+    "Num_Rows",
+    "Num_Columns"
+]
+
+def getReportFlags(Interoperability_Info, Reusability_Info):
+    flags = []
+    for l in reportLabels[:6]:
+        flags.append("+" if Interoperability_Info[l] else "-")
+    for l in reportLabels[6:12]:
+        flags.append("+" if Reusability_Info[l] else "-")
+    flags.append(Interoperability_Info["InteroperabilityPoints"] + Reusability_Info["ReusabilityPoints"])
+    return flags
+
+def writeDatasetSheet(ws, url, Interoperability_Info, Reusability_Info, File_Info):
+    # лист пишется строго сверху вниз, поэтому подходит и для write_only книги
+    num_columns = File_Info["num_columns"]
+    haveQuantiles = "median_values" in File_Info
+    
+    header = list(reportLabels)
+    values = getReportFlags(Interoperability_Info, Reusability_Info) + [File_Info["num_rows"], num_columns]
+    if File_Info.get("sampled"):
+        header += ["Sample_Size", "Estimated_Rows"]
+        values += [File_Info["sample_size"], File_Info["estimated_rows"]]
+    ws.append(header)
+    ws.append(values)
+    ws.append([])
+    ws.append([])
+    ws.append([])
+    
+    columnsHeader = [None, "пустые строки", "уникальные строки", "число 0", "максимум", "минимум", "среднее"]
+    if haveQuantiles:
+        columnsHeader += ["медиана", "p95"]
+    ws.append(columnsHeader)
+    
+    for i in range(num_columns):
+        row = [
+            File_Info["column_names"][i],
+            File_Info["missing_values"][i],
+            File_Info["unique_values"][i],
+            File_Info["amount_zero"][i],
+            File_Info["max_values"][i],
+            File_Info["min_values"][i],
+            File_Info["mean_values"][i],
+        ]
+        if haveQuantiles:
+            row += [File_Info["median_values"][i], File_Info["p95_values"][i]]
+        ws.append(row)
+    
+    ws.append([])
+    ws.append([])
+    ws.append(["ссылка", url])
+
 def makeExcel(fileName, url, Interoperability_Info, Reusability_Info, File_Info):
     if not File_Info:
         return
     
     fileName = fileName + ".xlsx"
     
-    wb = openpyxl.Workbook()
-    
-    ws = wb[wb.sheetnames[0]]
-    ws.title = "Лист1"
-    
-    label = [    
-        "Format",
-        "Media_type",
-        "Format_Media_type_from_vocabulary",
-        "Non_proprietary",
-        "Machine_readable",
-        "DCATAP_compliance",
-        "License_information",
-        "License_vocabulary",
-        "Access_restrictions",
-        "Access_restrictions_vocabulary",
-        "Contact_point",
-        "Publisher",
-        "Rating",
-        "Num_Rows",
-        "Num_Columns"
-    ]
+    wb = openpyxl.Workbook(write_only = True)
+    ws = wb.create_sheet("Лист1")
     
-    for i in range(1, 6 + 6 + 3 + 1):
-        cell = ws.cell(row = 1, column = i)
-        cell.value = label[i - 1]
+    writeDatasetSheet(ws, url, Interoperability_Info, Reusability_Info, File_Info)
 
-    for i in range(1, 6 + 1):
-        cell = ws.cell(row = 2, column = i)
-        if Interoperability_Info[label[i - 1]]:
-            cell.value = "+"
-        else:
-            cell.value = "-"
-        
-        cell = ws.cell(row = 2, column = i + 6)
-        if Reusability_Info[label[i + 6 - 1]]:
-            cell.value = "+"
-        else:
-            cell.value = "-"
+    wb.save(fileName)
 
-    cell = ws.cell(row = 2, column = 13)
-    cell.value = Interoperability_Info["InteroperabilityPoints"] + Reusability_Info["ReusabilityPoints"]
+class RowCounter:
+    # write_only лист не знает своей длины, номер строки считаем сами
+    
+    def __init__(self, ws):
+        self.ws = ws
+        self.rows = 0
+    
+    def append(self, row):
+        self.ws.append(row)
+        self.rows += 1
+
+def openRunReport(fileName):
+    # общая книга прогона: лист Summary со строкой на датасет и лист Profiles
+    # с профилями столбцов датасетов блоками друг под другом; у write_only
+    # листа до сохранения открыт свой временный файл, поэтому листов всего два
+    wb = openpyxl.Workbook(write_only = True)
+    summary = wb.create_sheet("Summary")
+    summary.append(["Dataset", "Title"] + reportLabels + ["Url", "Profile_Row"])
+    profiles = RowCounter(wb.create_sheet("Profiles"))
+    return {"fileName": fileName, "workbook": wb, "summary": summary, "profiles": profiles}
+
+def appendRunReport(report, url, title, Interoperability_Info, Reusability_Info, File_Info):
+    profileRow = None
+    if File_Info:
+        profiles = report["profiles"]
+        if profiles.rows:
+            profiles.append([])
+            profiles.append([])
+        profileRow = profiles.rows + 1
+        profiles.append([createId(url), title])
+        writeDatasetSheet(profiles, url, Interoperability_Info, Reusability_Info, File_Info)
+    
+    row = [createId(url), title] + getReportFlags(Interoperability_Info, Reusability_Info)
+    if File_Info:
+        row += [File_Info["num_rows"], File_Info["num_columns"]]
+    else:
+        row += [None, None]
+    row += [url, profileRow]
+    report["summary"].append(row)
 
-    num_columns = File_Info["num_columns"]
+def closeRunReport(report):
+    directory = os.path.dirname(report["fileName"])
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+    report["workbook"].save(report["fileName"])
 
-    cell = ws.cell(row = 2, column = 14)
-    cell.value = File_Info["num_rows"]
-    cell = ws.cell(row = 2, column = 15)
-    cell.value = num_columns
-    
-    ws["B6"] = "пустые строки"
-    ws["C6"] = "уникальные строки"
-    ws["D6"] = "число 0"
-    ws["E6"] = "максимум"
-    ws["F6"] = "минимум"
-    ws["G6"] = "среднее"
-    
-    column_names   = File_Info["column_names"]
-    missing_values = File_Info["missing_values"]
-    unique_values  = File_Info["unique_values"]
-    amount_zero    = File_Info["amount_zero"]
-    min_values     = File_Info["min_values"]
-    max_values     = File_Info["max_values"]
-    mean_values    = File_Info["mean_values"]
-    
-    for i in range(1, num_columns + 1):
-        ws.cell(row = i + 6, column = 1).value = column_names[i - 1]
-        ws.cell(row = i + 6, column = 2).value = missing_values[i - 1]
-        ws.cell(row = i + 6, column = 3).value = unique_values[i - 1]
-        ws.cell(row = i + 6, column = 4).value = amount_zero[i - 1]
-        ws.cell(row = i + 6, column = 5).value = max_values[i - 1]
-        ws.cell(row = i + 6, column = 6).value = min_values[i - 1]
-        ws.cell(row = i + 6, column = 7).value = mean_values[i - 1]
-
-    ws.cell(row = 6 + 3 + num_columns, column = 1).value = "ссылка"
-    ws.cell(row = 6 + 3 + num_columns, column = 2).value = url
 
-    wb.save(fileName)
 
+# -----------------------------------------------
 
 
-# -----------------------------------------------
 
+stateConnection = None
+stateLock = threading.Lock()
+stateSchemaVersion = 2
+
+# не случайные сбои: повторная проверка даст то же самое
+stableFailures = {"download_html"}
+
+def getStateStore():
+    global stateConnection
+    with stateLock:
+        if stateConnection is None:
+            directory = os.path.dirname(stateFile)
+            if directory:
+                os.makedirs(directory, exist_ok = True)
+            connection = sqlite3.connect(stateFile, check_same_thread = False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            # состояние - только кэш: таблица старой схемы пересоздаётся
+            if connection.execute("PRAGMA user_version").fetchone()[0] != stateSchemaVersion:
+                connection.execute("DROP TABLE IF EXISTS datasets")
+                connection.execute("PRAGMA user_version = " + str(stateSchemaVersion))
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS datasets ("
+                " url TEXT PRIMARY KEY,"
+                " checked_at REAL,"
+                " modified TEXT,"
+                " page_hash TEXT,"
+                " source_hash TEXT,"
+                " settings TEXT,"
+                " complete INTEGER,"
+                " result TEXT)"
+            )
+            connection.commit()
+            stateConnection = connection
+    return stateConnection
+
+def loadState(url):
+    # ключ - полный адрес: createId у адресов вне каталога даёт общий "temp"
+    connection = getStateStore()
+    with stateLock:
+        row = connection.execute(
+            "SELECT checked_at, modified, page_hash, source_hash, settings, complete, result FROM datasets WHERE url = ?", (url,)
+        ).fetchone()
+    if row is None:
+        return None
+    return {
+        "checked_at":  row[0],
+        "modified":    row[1],
+        "page_hash":   row[2],
+        "source_hash": row[3],
+        "settings":    row[4],
+        "complete":    bool(row[5]),
+        "result":      json.loads(row[6]) if row[6] else None,
+    }
 
+def saveState(url, marker, result, complete):
+    # запись сразу фиксируется: прерванный прогон продолжается с того же места
+    connection = getStateStore()
+    with stateLock:
+        connection.execute(
+            "INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (url, time.time(), marker["modified"], marker["page_hash"], marker["source_hash"],
+             getCheckSettings(), int(complete), json.dumps(toJsonValue(result), ensure_ascii = False))
+        )
+        connection.commit()
+
+def closeStateStore():
+    global stateConnection
+    with stateLock:
+        if stateConnection is not None:
+            stateConnection.close()
+            stateConnection = None
+
+def hashText(text):
+    if text is None:
+        return None
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def findStateMarker(page, text):
+    return {
+        "modified":    findDataInTable(page, "Metadata Updated Date"),
+        "page_hash":   hashText(text),
+        "source_hash": hashText(findSourceText(page)),
+    }
+
+def getCheckSettings():
+    # настройки, от которых зависит результат: после их смены датасет проверяется заново
+    settings = {
+        "files":     checkDataFiles,
+        "probe":     probeDataFiles,
+        "profiling": profilingMode,
+        "dcatap":    dcatapValidator,
+        "fallback":  dcatapRemoteFallback,
+    }
+    if profilingMode == "sample":
+        settings["sampleRows"] = sampleRows
+        settings["sampleMethod"] = sampleMethod
+    return json.dumps(settings, sort_keys = True)
+
+def isReusable(state):
+    # результат с неудачным скачиванием, профилированием или проверкой DCAT-AP
+    # не сохраняется навсегда, а повторяется в следующем прогоне
+    if state is None or state["result"] is None or not state["complete"]:
+        return False
+    return state["settings"] == getCheckSettings()
+
+def isComplete():
+    return not [kind for kind in checkFailures.kinds if kind not in stableFailures]
+
+def isUnchanged(state, marker):
+    if not isReusable(state):
+        return False
+    if marker["source_hash"] != state["source_hash"]:
+        return False
+    # дата изменения в каталоге надежнее хэша страницы,
+    # в разметке которой бывают меняющиеся от запроса к запросу куски
+    if marker["modified"] is not None:
+        return marker["modified"] == state["modified"]
+    return marker["page_hash"] == state["page_hash"]
+
+def printStoredResult(result):
+    print(" @ title:       " + str(result["title"]))
+    printConsole(result["Interoperability_Info"], result["Reusability_Info"], result["File_Info"])
 
 def checkOne(url, mediaTypeVocabulary, licencesVocabulary, generateExcelReport):
-    r = requests.get(url)
+    timings = {}
+    started = time.perf_counter()
+    checkFailures.kinds = []
+    
+    state = None
+    if useStateStore:
+        state = loadState(url)
+        if isReusable(state) and time.time() - state["checked_at"] < stateMaxAge:
+            if metadataSource == "ckan":
+                discardPackage(url)
+            log.info("проверен недавно, пропуск")
+            countMetric("datasets_skipped")
+            printStoredResult(state["result"])
+            return state["result"]
+    
+    try:
+        with timeStage(timings, "fetch"):
+            status, text, page = fetchPage(url)
+    except requests.exceptions.RequestException as e:
+        print("Ошибка:", e)
+        countFailure("fetch_" + type(e).__name__)
+        return
     
-    if r.status_code != 200:
-        print("Ошибка:", r.status_code)
+    if status != 200:
+        print("Ошибка:", status)
+        countFailure("fetch_status_" + str(status))
         return
     
-    soup = bs(r.text, "html.parser")
-
-    title = findTitle(soup)
-    access = findAccessRestrictions(soup)
-    license = findLicense(soup)
-    formats = findFormats(soup)
-    mediaTypes, mediaDownloadURL = findMediaType(soup)
+    with timeStage(timings, "parse"):
+        if page is None:
+            page = runCpu(indexPage, text)
+    
+    if useStateStore:
+        with timeStage(timings, "datajson"):
+            marker = findStateMarker(page, text)
+        if isUnchanged(state, marker):
+            log.info("без изменений, пропуск")
+            countMetric("datasets_skipped")
+            saveState(url, marker, state["result"], True)
+            printStoredResult(state["result"])
+            return state["result"]
+    
+    with timeStage(timings, "parse"):
+        title = findTitle(page)
+        access = findAccessRestrictions(page)
+        license = findLicense(page)
+        formats = findFormats(page)
+    with timeStage(timings, "datajson"):
+        mediaTypes, mediaDownloadURL = findMediaType(page)
+    
+    fileDownloadURL = findDownloadLinks(page)
+    
+    probes = None
+    if probeDataFiles:
+        with timeStage(timings, "probe"):
+            probes = probeDownloadLinks(fileDownloadURL)
+        formats = findDetectedFormats(formats, fileDownloadURL, probes)
     
     # Interoperability
     
@@ -731,7 +3137,8 @@ def checkOne(url, mediaTypeVocabulary, licencesVocabulary, generateExcelReport):
     Non_proprietary = isNonProprietaryFormat(formats)
     Machine_readable = isMachineReadableFormats(formats)
     
-    DCATAP_compliance = checkComplianceDCATAP(mediaDownloadURL, createId(url))
+    with timeStage(timings, "validate"):
+        DCATAP_compliance = checkComplianceDCATAP(mediaDownloadURL, createId(url))
     # DCATAP_compliance = False
     
     interoperabilityPoints = 0
@@ -760,8 +3167,8 @@ def checkOne(url, mediaTypeVocabulary, licencesVocabulary, generateExcelReport):
     Access_restrictions = haveAccessRestrictions(access)
     Access_restrictions_vocabulary = isAccessRestrictionsVocabulary(access)
     
-    Contact_point = haveContact(soup)
-    Publisher = havePublisher(soup)
+    Contact_point = haveContact(page)
+    Publisher = havePublisher(page)
     
     reusabilityPoints = 0
     if License_information:            reusabilityPoints += 20
@@ -783,9 +3190,9 @@ def checkOne(url, mediaTypeVocabulary, licencesVocabulary, generateExcelReport):
     
     # File
     
-    fileDownloadURL = findDownloadLinks(soup)
-    
-    File_Info = checkFiles(fileDownloadURL, createId(url))
+    File_Info = None
+    if checkDataFiles:
+        File_Info = checkFiles(fileDownloadURL, createId(url), timings, probes)
     
     # Output
     print(" @ title:       " + str(title))
@@ -801,25 +3208,323 @@ def checkOne(url, mediaTypeVocabulary, licencesVocabulary, generateExcelReport):
     # Excel
     
     if generateExcelReport:
-        if not os.path.exists("reports"):
-            os.mkdir("reports")
+        os.makedirs("reports", exist_ok = True)
         
         fileName = createId(url)
         filePath = os.path.join("reports", fileName)
         
-        makeExcel(filePath, url, Interoperability_Info, Reusability_Info, File_Info)
-
+        with timeStage(timings, "excel"):
+            makeExcel(filePath, url, Interoperability_Info, Reusability_Info, File_Info)
+    
+    timings["total"] = time.perf_counter() - started
+    for name, seconds in timings.items():
+        observeStage(name, seconds)
+    countMetric("datasets_checked")
+    
+    result = {
+        "url":                   url,
+        "id":                    createId(url),
+        "checked_at":            datetime.now(timezone.utc).isoformat(timespec = "seconds"),
+        "title":                 title,
+        "formats":               formats,
+        "media_types":           mediaTypes,
+        "licenses":              license,
+        "access":                access,
+        "Interoperability_Info": Interoperability_Info,
+        "Reusability_Info":      Reusability_Info,
+        "File_Info":             File_Info,
+        "timings":               timings,
+    }
+    
+    if useStateStore:
+        saveState(url, marker, result, isComplete())
+    
+    return result
+
+
+
+def printHeader(index, url):
+    print("\n" + str(index + 1) + " --------------------------------------------\n")
+    print(url)
+
+def checkOneBuffered(output, index, url, mediaTypeVocabulary, licencesVocabulary, generateExcelReport):
+    output.capture()
+    try:
+        printHeader(index, url)
+        with ioSlot():
+            result = checkOne(url, mediaTypeVocabulary, licencesVocabulary, generateExcelReport)
+    except Exception as e:
+        # датасет без результата и без записи в состоянии - проверится в следующий прогон
+        countFailure("check_" + type(e).__name__)
+        log.exception("проверка %s прервана", url)
+        return output.release(), None
+    return output.release(), result
+
+def toJsonValue(value):
+    # numpy-числа -> обычные, NaN -> null
+    if isinstance(value, dict):
+        return {str(k): toJsonValue(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [toJsonValue(v) for v in value]
+    if hasattr(value, "item") and not isinstance(value, (str, bytes)):
+        value = value.item()
+    if isinstance(value, float) and (math.isnan(value) or math.isinf(value)):
+        return None
+    return value
+
+def openResults(fileName):
+    directory = os.path.dirname(fileName)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+    return open(fileName, "w", encoding="utf-8")
+
+def appendResult(results, result):
+    # одна строка JSON на датасет, сразу на диск
+    results.write(json.dumps(toJsonValue(result), ensure_ascii = False) + "\n")
+    results.flush()
+
+def compactResults(fileName, parquetFileName):
+    # JSONL прогона -> одна таблица Parquet: флаги и баллы - отдельные столбцы,
+    # профиль столбцов файла - строкой JSON
+    rows = []
+    with open(fileName, "r", encoding="utf-8") as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            row = {
+                "url":         record["url"],
+                "id":          record["id"],
+                "checked_at":  record["checked_at"],
+                "title":       record["title"],
+                "formats":     record["formats"],
+                "media_types": record["media_types"],
+                "licenses":    record["licenses"],
+                "access":      record["access"],
+            }
+            for key, value in record["Interoperability_Info"].items():
+                row[key] = value
+            for key, value in record["Reusability_Info"].items():
+                row[key] = value
+            File_Info = record["File_Info"]
+            row["num_rows"] = File_Info["num_rows"] if File_Info else None
+            row["num_columns"] = File_Info["num_columns"] if File_Info else None
+            row["File_Info"] = json.dumps(File_Info, ensure_ascii = False) if File_Info else None
+            for key, value in record["timings"].items():
+                row["time_" + key] = value
+            rows.append(row)
+    
+    try:
+        pd.DataFrame(rows).to_parquet(parquetFileName, index = False)
+    except ImportError as e:
+        log.warning("Parquet не записан, нет pyarrow: %s", e)
+        return False
+    return True
 
+def saveResult(runReport, results, result):
+    # результаты приходят в порядке входного списка
+    if result is None:
+        return
+    if results is not None:
+        appendResult(results, result)
+    if runReport is not None:
+        appendRunReport(
+            runReport, result["url"], result["title"],
+            result["Interoperability_Info"], result["Reusability_Info"], result["File_Info"]
+        )
 
 def checkAll(listURL, generateExcelReport):
-    mediaTypeVocabulary = getMediaTypeVocabulary()
-    licencesVocabulary = getLicencesVocabulary()
-    
-    for index, url in enumerate(listURL):
-        print("\n" + str(index + 1) + " --------------------------------------------\n")
-        print(url)
-        
-        checkOne(url, mediaTypeVocabulary, licencesVocabulary, generateExcelReport)
+    setupLogging()
+    
+    mediaTypeVocabulary = makeVocabularyIndex(getMediaTypeVocabulary(), normalizeMediaType)
+    licencesVocabulary = makeVocabularyIndex(getLicencesVocabulary(), normalizeLicense)
+    
+    runReport = None
+    if generateRunReport:
+        runReport = openRunReport(runReportFile)
+    results = None
+    if generateResults:
+        results = openResults(resultsFile)
+    
+    if metadataSource == "ckan":
+        listURL = prefetchPackages(listURL)
+    
+    try:
+        if maxWorkers <= 1:
+            for index, url in enumerate(listURL):
+                printHeader(index, url)
+                try:
+                    result = checkOne(url, mediaTypeVocabulary, licencesVocabulary, generateExcelReport)
+                except Exception as e:
+                    countFailure("check_" + type(e).__name__)
+                    log.exception("проверка %s прервана", url)
+                    continue
+                saveResult(runReport, results, result)
+        else:
+            checkAllConcurrent(listURL, mediaTypeVocabulary, licencesVocabulary, generateExcelReport, runReport, results)
+    finally:
+        if runReport is not None:
+            closeRunReport(runReport)
+        if results is not None:
+            results.close()
+        closeStateStore()
+        shutdownCpuPool()
+        writeMetrics()
+    
+    if results is not None and resultsParquetFile:
+        compactResults(resultsFile, resultsParquetFile)
+    
+    printRunStats()
+
+def checkAllConcurrent(listURL, mediaTypeVocabulary, licencesVocabulary, generateExcelReport, runReport, results):
+    global ioSlots
+    output = ThreadOutput(sys.stdout)
+    sys.stdout = output
+    ioSlots = threading.BoundedSemaphore(maxWorkers)
+    threads = getCheckThreads()
+    
+    def flushOne(pending):
+        text, result = pending.popleft().result()
+        output.stream.write(text)
+        saveResult(runReport, results, result)
+    
+    try:
+        with ThreadPoolExecutor(max_workers = threads) as executor:
+            pending = deque()
+            for index, url in enumerate(listURL):
+                pending.append(executor.submit(
+                    checkOneBuffered, output, index, url,
+                    mediaTypeVocabulary, licencesVocabulary, generateExcelReport
+                ))
+                # не забегаем далеко вперёд, вывод печатается по порядку
+                if len(pending) >= 2 * threads:
+                    flushOne(pending)
+            while pending:
+                flushOne(pending)
+    finally:
+        sys.stdout = output.stream
+        ioSlots = None
+
+outputChoices = ["excel", "run", "jsonl", "parquet", "metrics", "prometheus"]
+
+def parseArgs(argv = None):
+    parser = argparse.ArgumentParser(description = "Проверка датасетов каталога: совместимость, переиспользуемость, профиль файлов")
+    
+    source = parser.add_argument_group("датасеты")
+    source.add_argument("datasets", nargs = "*", help = "адреса страниц или имена датасетов (по умолчанию listURL)")
+    source.add_argument("--list", help = "файл со списком датасетов, \"-\" - stdin")
+    source.add_argument("--search", action = "store_true", help = "искать датасеты в каталоге")
+    source.add_argument("--organization", help = "поиск: организация")
+    source.add_argument("--tag", help = "поиск: тег")
+    source.add_argument("--modified-since", help = "поиск: изменённые после даты, например 2024-01-01T00:00:00Z")
+    source.add_argument("--catalog-url", help = "адрес каталога (по умолчанию " + catalogUrl + ")")
+    source.add_argument("--metadata", choices = ["html", "ckan"], help = "метаданные со страницы или из CKAN API")
+    
+    run = parser.add_argument_group("выполнение")
+    run.add_argument("--workers", type = int, help = "датасетов одновременно")
+    run.add_argument("--per-host", type = int, help = "запросов одновременно к одному хосту")
+    run.add_argument("--cpu-workers", type = int, help = "процессов для разбора и профилирования, 0 - без пула")
+    run.add_argument("--cache-dir", help = "каталог кэшей и состояния")
+    run.add_argument("--no-state", action = "store_true", help = "не пропускать датасеты, проверенные раньше")
+    run.add_argument("--log-level", choices = ["DEBUG", "INFO", "WARNING", "ERROR"], help = "уровень отладочного вывода")
+    
+    checks = parser.add_argument_group("проверки")
+    checks.add_argument("--no-files", action = "store_true", help = "не скачивать и не профилировать файлы")
+    checks.add_argument("--no-probe", action = "store_true", help = "оценивать форматы по подписям каталога, не читая начало каждой ссылки")
+    checks.add_argument("--profiling", choices = ["exact", "approximate", "sample"], help = "режим профилирования")
+    checks.add_argument("--sample-rows", type = int, help = "строк в выборке для --profiling sample")
+    checks.add_argument("--csv-engine", choices = ["c", "pyarrow"], help = "чтение CSV")
+    checks.add_argument("--dcatap", choices = ["local", "remote"], help = "проверка DCAT-AP в процессе или через сервис")
+    checks.add_argument("--dcatap-fallback", action = "store_true", help = "без rdflib/pyshacl проверять DCAT-AP через сервис")
+    checks.add_argument("--compare-dcatap", metavar = "DIR", help = "сверить локальную проверку DCAT-AP и сервис на образцах из DIR и выйти")
+    
+    output = parser.add_argument_group("вывод")
+    output.add_argument("--output", help = "что записывать через запятую (по умолчанию всё): " + ",".join(outputChoices))
+    
+    args = parser.parse_args(argv)
+    if args.output is not None:
+        args.output = [o.strip() for o in args.output.split(",") if o.strip()]
+        for o in args.output:
+            if o not in outputChoices:
+                parser.error("неизвестный вывод: " + o)
+    return args
+
+def applyArgs(args):
+    # параметры командной строки перекрывают настройки внизу файла
+    settings = {}
+    
+    if args.catalog_url:
+        settings["catalogUrl"] = args.catalog_url.rstrip("/")
+        settings["ckanApiUrl"] = settings["catalogUrl"] + "/api/3/action"
+    if args.metadata:
+        settings["metadataSource"] = args.metadata
+    if args.search:
+        settings["discoverySource"] = "search"
+        settings["discoveryOrganization"] = args.organization
+        settings["discoveryTag"] = args.tag
+        settings["discoveryModifiedSince"] = args.modified_since
+    elif args.list:
+        settings["discoverySource"] = args.list
+    
+    if args.workers is not None:
+        settings["maxWorkers"] = args.workers
+    if args.per_host is not None:
+        settings["maxRequestsPerHost"] = args.per_host
+    if args.cpu_workers is not None:
+        settings["cpuWorkers"] = args.cpu_workers
+    if args.cache_dir:
+        settings["cacheDir"] = args.cache_dir
+        settings["stateFile"] = os.path.join(args.cache_dir, "state.sqlite")
+    if args.no_state:
+        settings["useStateStore"] = False
+    if args.log_level:
+        settings["logLevel"] = args.log_level
+    
+    if args.no_files:
+        settings["checkDataFiles"] = False
+    if args.no_probe:
+        settings["probeDataFiles"] = False
+    if args.profiling:
+        settings["profilingMode"] = args.profiling
+    if args.sample_rows is not None:
+        settings["sampleRows"] = args.sample_rows
+    if args.csv_engine:
+        settings["csvEngine"] = args.csv_engine
+    if args.dcatap:
+        settings["dcatapValidator"] = args.dcatap
+    if args.dcatap_fallback:
+        settings["dcatapRemoteFallback"] = True
+    
+    if args.output is not None:
+        settings["generateExcelReport"] = "excel" in args.output
+        settings["generateRunReport"] = "run" in args.output
+        settings["generateResults"] = "jsonl" in args.output or "parquet" in args.output
+        if "parquet" not in args.output:
+            settings["resultsParquetFile"] = None
+        if "metrics" not in args.output:
+            settings["metricsFile"] = None
+        if "prometheus" not in args.output:
+            settings["prometheusFile"] = None
+    
+    globals().update(settings)
+
+def main(argv = None):
+    args = parseArgs(argv)
+    applyArgs(args)
+    
+    if args.compare_dcatap:
+        setupLogging()
+        sys.exit(1 if compareDCATAPValidators(args.compare_dcatap) else 0)
+    
+    setupLogging()
+    if not checkDCATAPValidator():
+        sys.exit(2)
+    
+    if args.datasets:
+        listURL = [makeDatasetUrl(dataset) for dataset in args.datasets]
+    else:
+        listURL = getDatasetUrls()
+    checkAll(listURL, generateExcelReport)
 
 
 
@@ -858,7 +3563,140 @@ listURL = [
 
 generateExcelReport = True
 
-
-
-checkAll(listURL, generateExcelReport)
+# скачивать и профилировать файлы датасета (False - только метаданные и DCAT-AP)
+checkDataFiles = True
+
+# проверка DCAT-AP: "local" - SHACL в процессе (rdflib + pyshacl) по формам
+# из репозитория, без сети; "remote" - сервис data.europa.eu;
+# dcatapRemoteFallback - без rdflib/pyshacl или форм проверять через сервис,
+# иначе вердикт "ошибка проверки"
+dcatapValidator = "local"
+dcatapShapesFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "DCATAPShapes.ttl")
+dcatapRemoteFallback = False
+dcatapServiceUrl = "https://data.europa.eu/api/mqa/shacl/validation/report"
+# вердикты проверки по хэшу файла, типу и версии форм/сервиса; срок жизни в секундах
+useDCATAPCache = True
+dcatapCacheMaxAge = 7 * 24 * 3600
+
+# откуда брать метаданные: "html" - страница датасета и data.json,
+# "ckan" - JSON API каталога, пачками по ckanBatchSize датасетов
+metadataSource = "html"
+catalogUrl = "https://catalog.data.gov"
+ckanApiUrl = catalogUrl + "/api/3/action"
+ckanBatchSize = 100
+
+# общая книга прогона: лист Summary и профили столбцов всех датасетов
+generateRunReport = True
+runReportFile = os.path.join("reports", "run.xlsx")
+
+# результаты в JSONL (строка на датасет по мере проверки),
+# в конце прогона сжимаются в Parquet (None - не сжимать)
+generateResults = True
+resultsFile = os.path.join("reports", "results.jsonl")
+resultsParquetFile = os.path.join("reports", "results.parquet")
+
+# отладочный вывод " @ ...": "DEBUG" - всё, "INFO" - ход проверки и итоги, "WARNING" - только сбои
+logLevel = "INFO"
+# сводка прогона: время этапов, счётчики, сбои по типам (None - не писать)
+metricsFile = os.path.join("reports", "metrics.json")
+prometheusFile = os.path.join("reports", "metrics.prom")
+
+# сколько датасетов одновременно заняты сетью (1 - последовательно); ещё cpuWorkers
+# потоков ждут пул процессов, не занимая этих мест
+maxWorkers = 8
+# сколько запросов одновременно к одному хосту: окно начинается с hostStartConcurrency
+# и подстраивается под ответы хоста (AIMD), не выше maxRequestsPerHost
+maxRequestsPerHost = 8
+hostStartConcurrency = 2
+# запросов в секунду к хосту и запас токенов; hostRates - свои пределы для отдельных хостов
+hostRate = 10
+hostBurst = 20
+hostRates = {}
+# во сколько раз средняя задержка может вырасти над лучшей, прежде чем окно сузится
+hostLatencyFactor = 4
+
+# таймауты (подключение, чтение) в секундах
+httpTimeout = (10, 60)
+# повторы GET/HEAD при обрыве соединения или ответах 429/5xx
+httpRetries = 3
+httpBackoff = 0.5
+httpRetryStatuses = {429, 500, 502, 503, 504}
+# ответы "слишком часто": сужают окно хоста, их Retry-After приостанавливает хост;
+# дольше httpMaxRetryAfter секунд не ждём - запросы к хосту сразу завершаются ошибкой
+httpThrottleStatuses = {429, 503}
+httpMaxRetryAfter = 120
+# сколько хостов держат пул соединений
+httpPoolHosts = 32
+
+# каталог для кэшей
+cacheDir = "cache"
+
+# состояние прошлых прогонов: датасеты без изменений в каталоге не перепроверяются,
+# проверенные за последние stateMaxAge секунд пропускаются без запроса
+useStateStore = True
+stateFile = os.path.join(cacheDir, "state.sqlite")
+stateMaxAge = 12 * 3600
+
+# кэш страниц каталога и data.json с перепроверкой по ETag/Last-Modified
+useHttpCache = True
+httpCacheMaxBytes = 512 * 2**20
+
+# скачивание файлов: предельный размер, размер куска, шаг сообщений о прогрессе
+maxDownloadBytes = 2 * 2**30
+downloadChunkSize = 2**20
+downloadProgressStep = 64 * 2**20
+
+# перед скачиванием читаются первые probeBytes байт каждой ссылки: формат по
+# содержимому заменяет подпись каталога в оценке и выбирает профилировщик,
+# HTML-страницы не скачиваются; sniffLines строк для определения разделителя CSV
+probeDataFiles = True
+probeBytes = 64 * 2**10
+sniffLines = 50
+
+# кэш скачанных файлов: лимит в байтах, сколько секунд файл считается свежим,
+# проверять ли хэш при каждом чтении
+downloadCacheMaxBytes = 20 * 2**30
+downloadCacheMaxAge = 24 * 3600
+verifyDownloadCache = True
+
+# сколько строк CSV читается за раз при профилировании
+profileChunkRows = 100000
+# "exact" - точные уникальные значения,
+# "approximate" - HyperLogLog (ошибка ~0.8%, в пределах ±2%) и медиана/p95
+# по выборке (ошибка ранга в пределах ±1.5%), память на столбец постоянна,
+# "sample" - статистика по выборке из sampleRows строк: первые строки файла
+# ("head") или равномерная выборка по всему файлу ("reservoir")
+profilingMode = "exact"
+hllPrecision = 14
+quantileSampleSize = 10000
+sampleRows = 10000
+sampleMethod = "head"
+
+# чтение CSV с компактными типами по схеме из первых schemaScanRows строк;
+# csvEngine = "pyarrow" читает файл потоково через pyarrow
+useTypedCsv = True
+schemaScanRows = 10000
+categoryMaxUnique = 1000
+csvEngine = "c"
+
+
+# откуда брать датасеты: None - listURL выше, "search" - поиск по каталогу
+# (организация, тег, изменённые после даты), иначе файл со списком или "-" для stdin
+discoverySource = None
+discoveryOrganization = None
+discoveryTag = None
+discoveryModifiedSince = None # например "2024-01-01T00:00:00Z"
+discoveryPageSize = 1000
+discoveryPrefetchPages = 2
+
+
+# процессы для разбора страниц и профилирования (None - по числу ядер, 0 - в потоках проверки);
+# сколько скачанных файлов может ждать профилирования (None - 2 на процесс)
+cpuWorkers = None
+maxPendingFiles = None
+
+
+
+if __name__ == "__main__":
+    main()
 